@@ -6,25 +6,66 @@ Deployed as a Vercel serverless function.
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
 import os
+import re
 import hashlib
+import functools
 import time
-import urllib.request
-import urllib.error
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import orjson
+import urllib3
+
+from api.utils.hedge import race
 
 # ---------------------------------------------------------------------------
 # In-memory caches (persist across warm invocations on the same Vercel instance)
 # ---------------------------------------------------------------------------
-_analysis_cache = {}          # key: hash -> {"result": ..., "ts": ...}
+_analysis_cache = OrderedDict()  # key: hash -> {"result": ..., "ts": ...}, LRU order
 _CACHE_TTL = 600              # 10 minutes
+_CACHE_MAX_ENTRIES = 128
+_CACHE_SWEEP_EVERY = 128      # full TTL prune every N writes
+_writes_since_sweep = 0
 
-_rate_limit_store = {}        # key: ip -> [timestamp, ...]
+_rate_limit_store = OrderedDict()  # key: ip -> (window_id, prev_count, curr_count), LRU order
 _RATE_LIMIT_WINDOW = 60       # 1 minute
 _RATE_LIMIT_MAX = 20          # max requests per window
+_RATE_LIMIT_MAX_IPS = 10000    # LRU cap on tracked IPs
+_RATE_LIMIT_SWEEP_EVERY = 512  # drop idle IPs every N checks
+_rate_limit_calls = 0
 
 GEMINI_MODELS = ["gemini-2.5-flash", "gemini-2.0-flash"]
 MAX_VEHICLES = 20
+_MAX_BODY_BYTES = 256 * 1024
+
+_GEMINI_URL = (
+    "https://generativelanguage.googleapis.com/v1beta/"
+    "models/{model}:generateContent?key={key}"
+)
+_GENERATION_CONFIG = {"temperature": 0.7, "maxOutputTokens": 2048}
+_JSON_HEADERS = {"Content-Type": "application/json"}
+# Either fence may be missing: truncated output often stops before the closing one
+_FENCE_RE = re.compile(r"^\s*(?:```[\w-]*[ \t]*\n?)?(.*?)\s*(?:```\s*)?$", re.DOTALL)
+
+# Lets Vercel's edge serve repeat GET analyses without invoking the function
+_CACHE_CONTROL = "public, s-maxage=600, stale-while-revalidate=3600"
+
+# Keep-alive connection pool to the Gemini API, reused across warm invocations
+_http = urllib3.PoolManager(
+    num_pools=2,
+    maxsize=8,
+    timeout=urllib3.Timeout(connect=5, read=30),
+    retries=urllib3.Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+)
+
+_HEDGE_AFTER = 3.0  # seconds before the fallback model is raced against the primary
 
 
 # ---------------------------------------------------------------------------
@@ -37,42 +78,88 @@ def _cors_headers(handler):
     handler.send_header("Access-Control-Allow-Headers", "Content-Type")
 
 
-def _json_response(handler, status, data):
+def _json_response(handler, status, data, cacheable=False):
+    body = orjson.dumps(data)
     handler.send_response(status)
     handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    if cacheable and status == 200:
+        handler.send_header("Cache-Control", _CACHE_CONTROL)
     _cors_headers(handler)
     handler.end_headers()
-    handler.wfile.write(json.dumps(data).encode())
+    handler.wfile.write(body)
 
 
 def _cache_key(params, vehicle_count):
     """Create a deterministic hash from search params + vehicle count."""
-    raw = json.dumps({
-        "make": params.get("make", ""),
-        "model": params.get("model", ""),
-        "min_year": params.get("min_year"),
-        "max_year": params.get("max_year"),
-        "vehicle_count": vehicle_count,
-    }, sort_keys=True)
-    return hashlib.sha256(raw.encode()).hexdigest()
+    raw = "\x1f".join((
+        str(params.get("make", "")),
+        str(params.get("model", "")),
+        str(params.get("min_year") or ""),
+        str(params.get("max_year") or ""),
+        str(vehicle_count),
+    )).encode()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _cache_store(key, result, now):
+    """Insert an analysis, evicting with O(1) amortised work per write."""
+    global _writes_since_sweep
+    _analysis_cache[key] = {"result": result, "ts": now}
+    _analysis_cache.move_to_end(key)
+    if len(_analysis_cache) > _CACHE_MAX_ENTRIES:
+        _analysis_cache.popitem(last=False)
+
+    _writes_since_sweep += 1
+    if _writes_since_sweep >= _CACHE_SWEEP_EVERY:
+        _writes_since_sweep = 0
+        # Prune from the least-recently-used end; an expired entry that was
+        # recently read is dropped by its next lookup instead.
+        while _analysis_cache:
+            oldest = next(iter(_analysis_cache.values()))
+            if now - oldest["ts"] < _CACHE_TTL:
+                break
+            _analysis_cache.popitem(last=False)
 
 
 def _check_rate_limit(ip):
     """Return True if the IP is within the rate limit, False otherwise."""
-    now = time.time()
-    if ip not in _rate_limit_store:
-        _rate_limit_store[ip] = []
-
-    # Prune timestamps outside the window
-    _rate_limit_store[ip] = [
-        ts for ts in _rate_limit_store[ip]
-        if now - ts < _RATE_LIMIT_WINDOW
-    ]
-
-    if len(_rate_limit_store[ip]) >= _RATE_LIMIT_MAX:
+    global _rate_limit_calls
+    now = time.monotonic()
+    window_id, offset = divmod(now, _RATE_LIMIT_WINDOW)
+    window_id = int(window_id)
+
+    # Periodically forget IPs idle for two full windows. The store is kept in
+    # last-touch order, so idle IPs are all at the front.
+    _rate_limit_calls += 1
+    if _rate_limit_calls % _RATE_LIMIT_SWEEP_EVERY == 0:
+        while _rate_limit_store:
+            oldest_ip, (oldest_window, _, _) = next(iter(_rate_limit_store.items()))
+            if oldest_window >= window_id - 1:
+                break
+            del _rate_limit_store[oldest_ip]
+
+    entry = _rate_limit_store.get(ip)
+    if entry is None:
+        prev_count = curr_count = 0
+    else:
+        _rate_limit_store.move_to_end(ip)
+        stored_window, prev_count, curr_count = entry
+        if stored_window == window_id - 1:
+            prev_count, curr_count = curr_count, 0
+        elif stored_window != window_id:
+            prev_count = curr_count = 0
+
+    # Sliding-window estimate: weight the previous window by how much of it
+    # still overlaps the last _RATE_LIMIT_WINDOW seconds.
+    weighted = prev_count * (1 - offset / _RATE_LIMIT_WINDOW) + curr_count
+    if weighted >= _RATE_LIMIT_MAX:
+        _rate_limit_store[ip] = (window_id, prev_count, curr_count)
         return False
 
-    _rate_limit_store[ip].append(now)
+    _rate_limit_store[ip] = (window_id, prev_count, curr_count + 1)
+    if entry is None and len(_rate_limit_store) > _RATE_LIMIT_MAX_IPS:
+        _rate_limit_store.popitem(last=False)
     return True
 
 
@@ -84,26 +171,7 @@ def _get_client_ip(handler):
     return handler.headers.get("x-real-ip", "unknown")
 
 
-def _build_prompt(make, model, min_year, max_year, vehicles):
-    """Build the Gemini prompt for market analysis."""
-    vehicle_list = "\n".join(
-        f"  {i+1}. {v.get('title', 'Unknown')} | "
-        f"Price: ${v.get('price', 0):,} | "
-        f"Mileage: {v.get('mileage', 'N/A'):,} mi | "
-        f"Year: {v.get('year', 'N/A')} | "
-        f"Source: {v.get('source', 'Unknown')}"
-        for i, v in enumerate(vehicles)
-    )
-
-    year_range = ""
-    if min_year and max_year:
-        year_range = f"{min_year}-{max_year}"
-    elif min_year:
-        year_range = f"{min_year}+"
-    elif max_year:
-        year_range = f"up to {max_year}"
-
-    return f"""You are an automotive market analyst. Analyze the following used vehicle search results for a {make} {model} ({year_range}) in the Milwaukee, WI area.
+_PROMPT_TEMPLATE = """You are an automotive market analyst. Analyze the following used vehicle search results for a {make} {model} ({year_range}) in the Milwaukee, WI area.
 
 Listings:
 {vehicle_list}
@@ -133,66 +201,115 @@ Important:
 - Return ONLY the JSON object, nothing else."""
 
 
-def _call_gemini(prompt, api_key):
-    """Call the Gemini API, trying primary model then fallback."""
-    last_error = None
+_LINE_TEMPLATE = "  {i}. {title} | Price: ${price} | Mileage: {mileage} mi | Year: {year} | Source: {source}"
+
+
+def _fmt_int(value, default="N/A"):
+    """Thousands-separated number, or `default` for missing/non-numeric values."""
+    if isinstance(value, (int, float)):
+        return f"{value:,}"
+    return default
+
+
+def _build_prompt(make, model, min_year, max_year, vehicles):
+    """Build the Gemini prompt for market analysis."""
+    lines = []
+    append = lines.append
+    fmt = _LINE_TEMPLATE.format
+    for i, v in enumerate(vehicles, 1):
+        get = v.get
+        append(fmt(
+            i=i,
+            title=get("title", "Unknown"),
+            price=_fmt_int(get("price"), "0"),
+            mileage=_fmt_int(get("mileage")),
+            year=get("year", "N/A"),
+            source=get("source", "Unknown"),
+        ))
+    vehicle_list = "\n".join(lines)
+
+    year_range = ""
+    if min_year and max_year:
+        year_range = f"{min_year}-{max_year}"
+    elif min_year:
+        year_range = f"{min_year}+"
+    elif max_year:
+        year_range = f"up to {max_year}"
+
+    return _PROMPT_TEMPLATE.format(
+        make=make,
+        model=model,
+        year_range=year_range,
+        vehicle_list=vehicle_list,
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _model_url(model_name, api_key):
+    """Endpoint URL for a model, built once per (model, key) per container."""
+    return _GEMINI_URL.format(model=model_name, key=api_key)
+
+
+def _strip_fences(text):
+    """Strip markdown code fences (with optional language tag) and surrounding whitespace."""
+    return _FENCE_RE.match(text).group(1)
+
 
-    for model_name in GEMINI_MODELS:
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/"
-            f"models/{model_name}:generateContent?key={api_key}"
+def _try_model(model_name, api_key, payload):
+    """Run one model and return its analysis; raises RuntimeError on failure."""
+    try:
+        resp = _http.request(
+            "POST",
+            _model_url(model_name, api_key),
+            body=payload,
+            headers=_JSON_HEADERS,
         )
-        payload = json.dumps({
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 2048,
-            },
-        }).encode()
-
-        req = urllib.request.Request(
-            url,
-            data=payload,
-            headers={"Content-Type": "application/json"},
-            method="POST",
+        if resp.status != 200:
+            raise RuntimeError(f"{model_name}: HTTP {resp.status}")
+
+        body = orjson.loads(resp.data)
+
+        # Extract the text from Gemini's response
+        text = (
+            body.get("candidates", [{}])[0]
+            .get("content", {})
+            .get("parts", [{}])[0]
+            .get("text", "")
         )
 
-        try:
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                body = json.loads(resp.read().decode())
-
-            # Extract the text from Gemini's response
-            text = (
-                body.get("candidates", [{}])[0]
-                .get("content", {})
-                .get("parts", [{}])[0]
-                .get("text", "")
-            )
-
-            if not text:
-                last_error = f"Empty response from {model_name}"
-                continue
-
-            # Strip markdown code fences if present
-            cleaned = text.strip()
-            if cleaned.startswith("```"):
-                # Remove opening fence (with optional language tag)
-                cleaned = cleaned.split("\n", 1)[-1] if "\n" in cleaned else cleaned[3:]
-            if cleaned.endswith("```"):
-                cleaned = cleaned[:-3]
-            cleaned = cleaned.strip()
-
-            analysis = json.loads(cleaned)
-            return analysis
-
-        except (urllib.error.URLError, urllib.error.HTTPError) as e:
-            last_error = f"{model_name}: {str(e)}"
-            continue
-        except json.JSONDecodeError as e:
-            last_error = f"{model_name}: Invalid JSON in response - {str(e)}"
-            continue
-
-    raise RuntimeError(f"All Gemini models failed. Last error: {last_error}")
+        if not text:
+            raise RuntimeError(f"Empty response from {model_name}")
+
+        return orjson.loads(_strip_fences(text))
+
+    except urllib3.exceptions.HTTPError as e:
+        raise RuntimeError(f"{model_name}: {str(e)}")
+    except orjson.JSONDecodeError as e:
+        raise RuntimeError(f"{model_name}: Invalid JSON in response - {str(e)}")
+
+
+def _call_gemini(prompt, api_key):
+    """Call the Gemini API, hedging to the fallback model if the primary is slow.
+
+    The primary starts immediately. The next model is launched once the
+    current one fails or has been running for _HEDGE_AFTER seconds, and the
+    first successful answer wins.
+    """
+    # The request body is identical for every model, so encode it once
+    payload = orjson.dumps({
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": _GENERATION_CONFIG,
+    })
+
+    attempts = [
+        (name, functools.partial(_try_model, name, api_key, payload))
+        for name in GEMINI_MODELS
+    ]
+    winner, analysis, errors = race(attempts, _HEDGE_AFTER)
+    if winner is None:
+        last_error = list(errors.values())[-1]
+        raise RuntimeError(f"All Gemini models failed. Last error: {last_error}")
+    return analysis
 
 
 # ---------------------------------------------------------------------------
@@ -207,42 +324,88 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
-        _json_response(self, 200, {
-            "success": True,
-            "message": "Market Analysis API",
-            "status": "operational",
-            "usage": "POST with {make, model, min_year, max_year, vehicles: [...]}",
-        })
+        params = parse_qs(urlparse(self.path).query)
+        if not params:
+            _json_response(self, 200, {
+                "success": True,
+                "message": "Market Analysis API",
+                "status": "operational",
+                "usage": (
+                    "POST with {make, model, min_year, max_year, vehicles: [...]}, "
+                    "or GET with the same fields as query params (vehicles JSON-encoded)"
+                ),
+            })
+            return
 
-    def do_POST(self):
-        client_ip = _get_client_ip(self)
+        # Cache-friendly GET form of the POST endpoint
+        if not self._within_rate_limit():
+            return
 
-        # Rate limiting
-        if not _check_rate_limit(client_ip):
-            _json_response(self, 429, {
+        data = {key: values[0] for key, values in params.items()}
+        try:
+            data["vehicles"] = orjson.loads(data.get("vehicles") or "[]")
+        except ValueError:
+            _json_response(self, 400, {
                 "success": False,
-                "error": "Rate limit exceeded. Maximum 20 requests per minute.",
+                "error": "Query param 'vehicles' must be a JSON-encoded array.",
             })
             return
 
+        self._analyze(data)
+
+    def do_POST(self):
+        # Reject oversize bodies before any rate-limit bookkeeping or reads
         try:
             length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(length).decode("utf-8") if length > 0 else "{}"
-            data = json.loads(body)
-        except (json.JSONDecodeError, ValueError):
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            _json_response(self, 400, {
+                "success": False,
+                "error": "Invalid Content-Length header.",
+            })
+            return
+        if length > _MAX_BODY_BYTES:
+            _json_response(self, 413, {
+                "success": False,
+                "error": f"Request body too large (limit {_MAX_BODY_BYTES // 1024} KB).",
+            })
+            return
+
+        if not self._within_rate_limit():
+            return
+
+        try:
+            body = self.rfile.read(length) if length > 0 else b"{}"
+            data = orjson.loads(body)
+        except ValueError:
             _json_response(self, 400, {
                 "success": False,
                 "error": "Invalid JSON in request body.",
             })
             return
 
+        self._analyze(data)
+
+    def _within_rate_limit(self):
+        """Check the per-IP limit, sending a 429 when it is exceeded."""
+        if _check_rate_limit(_get_client_ip(self)):
+            return True
+        _json_response(self, 429, {
+            "success": False,
+            "error": "Rate limit exceeded. Maximum 20 requests per minute.",
+        })
+        return False
+
+    def _analyze(self, data):
+        """Validate the request, then serve the analysis from cache or Gemini."""
         make = data.get("make", "").strip()
         model = data.get("model", "").strip()
         min_year = data.get("min_year")
         max_year = data.get("max_year")
         vehicles = data.get("vehicles", [])
 
-        if not make or not vehicles:
+        if not make or not vehicles or not isinstance(vehicles, list):
             _json_response(self, 400, {
                 "success": False,
                 "error": "Request must include 'make' and a non-empty 'vehicles' array.",
@@ -254,16 +417,18 @@ class handler(BaseHTTPRequestHandler):
 
         # Check cache
         key = _cache_key(data, len(vehicles))
-        now = time.time()
-        if key in _analysis_cache:
-            cached = _analysis_cache[key]
+        now = time.monotonic()
+        cached = _analysis_cache.get(key)
+        if cached is not None:
             if now - cached["ts"] < _CACHE_TTL:
+                _analysis_cache.move_to_end(key)
                 _json_response(self, 200, {
                     "success": True,
                     "analysis": cached["result"],
                     "cached": True,
-                })
+                }, cacheable=True)
                 return
+            del _analysis_cache[key]
 
         # Require API key
         api_key = os.environ.get("GOOGLE_API_KEY")
@@ -291,19 +456,10 @@ class handler(BaseHTTPRequestHandler):
             })
             return
 
-        # Store in cache
-        _analysis_cache[key] = {"result": analysis, "ts": now}
-
-        # Evict stale entries
-        stale_keys = [
-            k for k, v in _analysis_cache.items()
-            if now - v["ts"] >= _CACHE_TTL
-        ]
-        for k in stale_keys:
-            del _analysis_cache[k]
+        _cache_store(key, analysis, now)
 
         _json_response(self, 200, {
             "success": True,
             "analysis": analysis,
             "cached": False,
-        })
+        }, cacheable=True)
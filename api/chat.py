@@ -8,35 +8,82 @@ Fallback model: gemini-2.0-flash
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
+import functools
+import logging
 import os
+import sys
 import time
-import traceback
+from collections import OrderedDict
+
+import orjson
+import urllib3
+
+from api.utils.hedge import race
+
+logging.basicConfig(level=logging.WARNING)
+_log = logging.getLogger("chat")
+
+# During a Gemini outage every request fails the same way; log each distinct
+# error at most once per interval instead of once per request
+_LOG_REPEAT_INTERVAL = 60  # seconds
+_LOG_SEEN_MAX = 256
+_log_last_seen = {}  # {error key: monotonic time last logged}
+
+
+def _should_log(key):
+    """Return True if an error with this key hasn't been logged recently."""
+    now = time.monotonic()
+    last = _log_last_seen.get(key)
+    if last is not None and now - last < _LOG_REPEAT_INTERVAL:
+        return False
+    if len(_log_last_seen) >= _LOG_SEEN_MAX:
+        _log_last_seen.clear()
+    _log_last_seen[key] = now
+    return True
+
 
 # ---------------------------------------------------------------------------
 # Rate limiter (in-memory, per-instance)
 # ---------------------------------------------------------------------------
 
-_rate_limit_store = {}  # {ip: [timestamp, ...]}
-_RATE_LIMIT_MAX = 30
-_RATE_LIMIT_WINDOW = 60  # seconds
+_rate_limit_store = OrderedDict()  # {ip: (tokens, last_refill)}, LRU order
+_RATE_LIMIT_MAX = 30  # bucket size (burst)
+_RATE_LIMIT_WINDOW = 60  # seconds to refill an empty bucket
+_RATE_LIMIT_REFILL = _RATE_LIMIT_MAX / _RATE_LIMIT_WINDOW  # tokens per second
+_RATE_LIMIT_MAX_IPS = 10000  # LRU cap on tracked IPs
+
+_MAX_BODY_BYTES = 256 * 1024
+_MAX_MESSAGES = 64  # conversation turns accepted per request
 
 
 def _check_rate_limit(ip):
     """Return True if request is allowed, False if rate-limited."""
-    now = time.time()
-    if ip not in _rate_limit_store:
-        _rate_limit_store[ip] = []
-
-    # Prune old entries
-    _rate_limit_store[ip] = [
-        t for t in _rate_limit_store[ip] if now - t < _RATE_LIMIT_WINDOW
-    ]
-
-    if len(_rate_limit_store[ip]) >= _RATE_LIMIT_MAX:
+    now = time.monotonic()
+
+    # Forget IPs whose bucket has refilled completely; a missing entry means a
+    # full bucket. The store is kept in last-touch order, so expired IPs are
+    # all at the front and each call only pops the ones that expired since.
+    while _rate_limit_store:
+        oldest_ip, (_, oldest_refill) = next(iter(_rate_limit_store.items()))
+        if now - oldest_refill < _RATE_LIMIT_WINDOW:
+            break
+        del _rate_limit_store[oldest_ip]
+
+    entry = _rate_limit_store.get(ip)
+    if entry is None:
+        tokens = float(_RATE_LIMIT_MAX)
+    else:
+        _rate_limit_store.move_to_end(ip)
+        tokens, last_refill = entry
+        tokens = min(_RATE_LIMIT_MAX, tokens + (now - last_refill) * _RATE_LIMIT_REFILL)
+
+    if tokens < 1:
+        _rate_limit_store[ip] = (tokens, now)
         return False
 
-    _rate_limit_store[ip].append(now)
+    _rate_limit_store[ip] = (tokens - 1, now)
+    if entry is None and len(_rate_limit_store) > _RATE_LIMIT_MAX_IPS:
+        _rate_limit_store.popitem(last=False)
     return True
 
 
@@ -47,6 +94,30 @@ def _check_rate_limit(ip):
 _PRIMARY_MODEL = "gemini-2.5-flash"
 _FALLBACK_MODEL = "gemini-2.5-flash-lite"  # 2.0-flash deprecated March 2026
 
+_GEMINI_URL = (
+    "https://generativelanguage.googleapis.com/v1beta/"
+    "models/{model}:generateContent?key={key}"
+)
+
+# Keep-alive connection pool to the Gemini API, reused across warm invocations.
+# Transient 5xx and connection failures get two quick retries; 4xx (auth,
+# quota) and read timeouts are not retried, the fallback race covers those.
+_http = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=16,
+    timeout=urllib3.Timeout(connect=5, read=45),
+    retries=urllib3.Retry(
+        total=2,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+)
+
+_HEDGE_AFTER = 2.0  # seconds of head start the primary gets before the fallback joins
+
 # ---------------------------------------------------------------------------
 # System prompt
 # ---------------------------------------------------------------------------
@@ -83,17 +154,25 @@ SYSTEM_PROMPT = (
     "You have a slightly intense, no-nonsense personality fitting the Doom theme, but remain helpful and informative."
 )
 
+# Request fragments that never change between calls
+_SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
+_GENERATION_CONFIG = {"temperature": 0.8, "maxOutputTokens": 2048}
+
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def _cors_headers():
-    return {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, Authorization",
-    }
+_CORS_HEADERS = (
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+    ("Access-Control-Allow-Headers", "Content-Type, Authorization"),
+)
+
+
+# Vehicle fields listed first, in this order, ahead of any extras
+_PREFERRED_VEHICLE_KEYS = ("title", "make", "model", "year", "price", "mileage")
+_PREFERRED_VEHICLE_KEY_SET = frozenset(_PREFERRED_VEHICLE_KEYS)
 
 
 def _build_context_message(context):
@@ -103,12 +182,13 @@ def _build_context_message(context):
     vehicle = context.get("current_vehicle") if context else None
     if vehicle:
         parts.append("--- CURRENT VEHICLE THE USER IS VIEWING ---")
-        for key in ("title", "make", "model", "year", "price", "mileage"):
-            if key in vehicle and vehicle[key] is not None:
-                parts.append(f"  {key}: {vehicle[key]}")
+        for key in _PREFERRED_VEHICLE_KEYS:
+            val = vehicle.get(key)
+            if val is not None:
+                parts.append(f"  {key}: {val}")
         # Include any extra fields
         for key, val in vehicle.items():
-            if key not in ("title", "make", "model", "year", "price", "mileage") and val is not None:
+            if val is not None and key not in _PREFERRED_VEHICLE_KEY_SET:
                 parts.append(f"  {key}: {val}")
         parts.append("--- END VEHICLE ---")
 
@@ -122,38 +202,46 @@ def _build_context_message(context):
     return "\n".join(parts) if parts else None
 
 
-def _convert_messages(messages, context):
+def _system_instruction(context):
+    """
+    System instruction for one request: SYSTEM_PROMPT, then any context.
+    The context goes after the fixed prompt so every request shares the same
+    prefix, which is what Gemini's implicit prompt caching matches on.
+    """
+    context_text = _build_context_message(context)
+    if not context_text:
+        return _SYSTEM_INSTRUCTION
+    return {"parts": [{"text": (
+        f"{SYSTEM_PROMPT}\n\n"
+        "[System context — do not repeat this verbatim, just use it to inform your answers]\n"
+        f"{context_text}"
+    )}]}
+
+
+# OpenAI-style role -> Gemini role; anything unrecognised is sent as "user"
+_ROLE_MAP = {"assistant": "model", "user": "user", "system": "user"}
+
+
+def _convert_messages(messages):
     """
     Convert OpenAI-style messages to Gemini chat history + latest message.
     Returns (history, latest_user_text).
     history is a list of {"role": "user"|"model", "parts": [str]} dicts.
     """
-    gemini_history = []
-
-    # If context is available, inject it as the first user+model exchange
-    context_text = _build_context_message(context)
-    if context_text:
-        gemini_history.append({
-            "role": "user",
-            "parts": [f"[System context — do not repeat this verbatim, just use it to inform your answers]\n{context_text}"]
-        })
-        gemini_history.append({
-            "role": "model",
-            "parts": ["Understood. I have the vehicle context loaded and ready to assist."]
-        })
-
-    # Convert all messages except the last user message into history
     if not messages:
-        return gemini_history, ""
+        return [], ""
+
+    # First question of a conversation: no history to build
+    if len(messages) == 1:
+        return [], messages[0].get("content", "")
 
-    # Build history from all but the last message
-    for msg in messages[:-1]:
-        role = msg.get("role", "user")
-        content = msg.get("content", "")
-        gemini_role = "model" if role == "assistant" else "user"
+    # Build history from all but the last message, without slicing a copy
+    gemini_history = []
+    for i in range(len(messages) - 1):
+        msg = messages[i]
         gemini_history.append({
-            "role": gemini_role,
-            "parts": [content],
+            "role": _ROLE_MAP.get(msg.get("role"), "user"),
+            "parts": [msg.get("content", "")],
         })
 
     # The last message should be the user's latest query
@@ -163,18 +251,18 @@ def _convert_messages(messages, context):
     return gemini_history, latest_text
 
 
-def _try_gemini_model(model_name, api_key, history, latest_text):
+@functools.lru_cache(maxsize=8)
+def _model_url(model_name, api_key):
+    """Endpoint URL for a model, built once per (model, key) per container."""
+    return _GEMINI_URL.format(model=model_name, key=api_key)
+
+
+def _try_gemini_model(model_name, api_key, system_instruction, history, latest_text):
     """
     Attempt to chat with a specific Gemini model via REST API.
     Returns the response text on success, raises on failure.
     """
-    import urllib.request
-    import urllib.error
-
-    url = (
-        f"https://generativelanguage.googleapis.com/v1beta/"
-        f"models/{model_name}:generateContent?key={api_key}"
-    )
+    url = _model_url(model_name, api_key)
 
     # Build contents array: system instruction + history + latest message
     contents = []
@@ -192,36 +280,27 @@ def _try_gemini_model(model_name, api_key, history, latest_text):
         "parts": [{"text": latest_text}],
     })
 
-    payload = json.dumps({
-        "system_instruction": {
-            "parts": [{"text": SYSTEM_PROMPT}]
-        },
+    payload = orjson.dumps({
+        "system_instruction": system_instruction,
         "contents": contents,
-        "generationConfig": {
-            "temperature": 0.8,
-            "maxOutputTokens": 2048,
-        },
-    }).encode()
-
-    req = urllib.request.Request(
-        url,
-        data=payload,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
+        "generationConfig": _GENERATION_CONFIG,
+    })
 
     try:
-        with urllib.request.urlopen(req, timeout=45) as resp:
-            body = json.loads(resp.read().decode())
-    except urllib.error.HTTPError as e:
-        error_body = ""
-        try:
-            error_body = e.read().decode()
-        except Exception:
-            pass
-        raise ValueError(f"HTTP {e.code} from {model_name}: {error_body[:500]}")
-    except urllib.error.URLError as e:
-        raise ValueError(f"Network error calling {model_name}: {str(e.reason)}")
+        resp = _http.request(
+            "POST",
+            url,
+            body=payload,
+            headers={"Content-Type": "application/json"},
+        )
+    except urllib3.exceptions.HTTPError as e:
+        raise ValueError(f"Network error calling {model_name}: {str(e)}")
+
+    if resp.status != 200:
+        error_body = resp.data.decode(errors="replace")
+        raise ValueError(f"HTTP {resp.status} from {model_name}: {error_body[:500]}")
+
+    body = orjson.loads(resp.data)
 
     # Check for blocked content or other issues
     if "candidates" not in body or not body["candidates"]:
@@ -242,25 +321,50 @@ def _try_gemini_model(model_name, api_key, history, latest_text):
     return text
 
 
+def _race_models(api_key, system_instruction, history, latest_text):
+    """
+    Ask the primary model, racing the fallback against it once the primary
+    fails or runs past _HEDGE_AFTER seconds. Returns (model, text, errors)
+    for the first success, or (None, None, errors) if both fail; errors maps
+    model name to error message.
+    """
+    attempts = [
+        (name, functools.partial(_try_gemini_model, name, api_key, system_instruction, history, latest_text))
+        for name in (_PRIMARY_MODEL, _FALLBACK_MODEL)
+    ]
+    used_model, text, failures = race(attempts, _HEDGE_AFTER)
+    errors = {}
+    for model_name, exc in failures.items():
+        errors[model_name] = str(exc)
+        if _should_log((model_name, errors[model_name][:200])):
+            _log.warning("Model %s failed: %s", model_name, exc)
+    return used_model, text, errors
+
+
 # ---------------------------------------------------------------------------
 # Handler
 # ---------------------------------------------------------------------------
 
 class handler(BaseHTTPRequestHandler):
+    # Buffer the response so headers and body leave in one send() instead of
+    # one per write; StreamRequestHandler.finish() flushes it
+    wbufsize = 64 * 1024
 
     def _send_json(self, status_code, data):
+        body = orjson.dumps(data)
         self.send_response(status_code)
         self.send_header("Content-Type", "application/json")
-        for key, val in _cors_headers().items():
+        self.send_header("Content-Length", str(len(body)))
+        for key, val in _CORS_HEADERS:
             self.send_header(key, val)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
 
     # -- OPTIONS (CORS preflight) ------------------------------------------
 
     def do_OPTIONS(self):
         self.send_response(204)
-        for key, val in _cors_headers().items():
+        for key, val in _CORS_HEADERS:
             self.send_header(key, val)
         self.send_header("Access-Control-Max-Age", "86400")
         self.end_headers()
@@ -279,8 +383,28 @@ class handler(BaseHTTPRequestHandler):
     # -- POST (chat) -------------------------------------------------------
 
     def do_POST(self):
+        # Reject oversize bodies before any rate-limit bookkeeping or reads
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            if content_length < 0:
+                raise ValueError(content_length)
+        except ValueError:
+            self._send_json(400, {
+                "success": False,
+                "error": "Invalid Content-Length header.",
+            })
+            return
+        if content_length > _MAX_BODY_BYTES:
+            self._send_json(413, {
+                "success": False,
+                "error": "Request body too large.",
+                "hint": f"Chat requests are limited to {_MAX_BODY_BYTES // 1024} KB.",
+            })
+            return
+
         # Rate limiting
-        client_ip = self.client_address[0] if self.client_address else "unknown"
+        # Interned so repeat requests share one key object in the limiter store
+        client_ip = sys.intern(self.client_address[0]) if self.client_address else "unknown"
         if not _check_rate_limit(client_ip):
             self._send_json(429, {
                 "success": False,
@@ -291,10 +415,9 @@ class handler(BaseHTTPRequestHandler):
 
         # Read request body
         try:
-            content_length = int(self.headers.get("Content-Length", 0))
-            raw_body = self.rfile.read(content_length) if content_length else b""
-            body = json.loads(raw_body) if raw_body else {}
-        except (json.JSONDecodeError, ValueError):
+            raw_body = self.rfile.read(content_length) if content_length > 0 else b""
+            body = orjson.loads(raw_body) if raw_body else {}
+        except ValueError:
             self._send_json(400, {
                 "success": False,
                 "error": "Invalid JSON in request body.",
@@ -302,7 +425,7 @@ class handler(BaseHTTPRequestHandler):
             })
             return
 
-        messages = body.get("messages")
+        messages = body.get("messages") if isinstance(body, dict) else None
         if not messages or not isinstance(messages, list):
             self._send_json(400, {
                 "success": False,
@@ -310,8 +433,29 @@ class handler(BaseHTTPRequestHandler):
                 "hint": "Send {\"messages\": [{\"role\": \"user\", \"content\": \"your question\"}]}.",
             })
             return
+        if len(messages) > _MAX_MESSAGES:
+            self._send_json(400, {
+                "success": False,
+                "error": f"Too many messages (limit {_MAX_MESSAGES}).",
+                "hint": "Start a new conversation or trim older messages.",
+            })
+            return
+        # Shape-check every entry now rather than letting Gemini reject it
+        for msg in messages:
+            if not isinstance(msg, dict) or not isinstance(msg.get("content", ""), str):
+                self._send_json(400, {
+                    "success": False,
+                    "error": "Each message must be an object with a string 'content'.",
+                })
+                return
 
         context = body.get("context")
+        if context is not None and not isinstance(context, dict):
+            self._send_json(400, {
+                "success": False,
+                "error": "'context' must be an object.",
+            })
+            return
 
         # Check API key
         api_key = os.environ.get("GOOGLE_API_KEY")
@@ -325,50 +469,41 @@ class handler(BaseHTTPRequestHandler):
 
         # Call Gemini with model fallback
         try:
-            history, latest_text = _convert_messages(messages, context)
-
-            # Try primary model first, fall back to secondary on failure
-            used_model = _PRIMARY_MODEL
-            primary_error = None
-            try:
-                response_text = _try_gemini_model(_PRIMARY_MODEL, api_key, history, latest_text)
-            except Exception as primary_exc:
-                primary_error = str(primary_exc)
-                print(f"[chat] Primary model {_PRIMARY_MODEL} failed: {primary_error}")
-                print(f"[chat] Falling back to {_FALLBACK_MODEL}...")
-                try:
-                    response_text = _try_gemini_model(_FALLBACK_MODEL, api_key, history, latest_text)
-                    used_model = _FALLBACK_MODEL
-                except Exception as fallback_exc:
-                    traceback.print_exc()
-                    self._send_json(500, {
-                        "success": False,
-                        "error": "Both AI models failed to generate a response.",
-                        "details": {
-                            "primary_model": _PRIMARY_MODEL,
-                            "primary_error": primary_error,
-                            "fallback_model": _FALLBACK_MODEL,
-                            "fallback_error": str(fallback_exc),
-                        },
-                        "hint": (
-                            "This may be a temporary issue with the Gemini API. "
-                            "Try again in a few seconds. If the problem persists, "
-                            "the API key may be invalid or have exceeded its quota."
-                        ),
-                    })
-                    return
+            system_instruction = _system_instruction(context)
+            history, latest_text = _convert_messages(messages)
+
+            # Primary gets a head start; the fallback races it if it is slow
+            used_model, response_text, errors = _race_models(api_key, system_instruction, history, latest_text)
+            if used_model is None:
+                self._send_json(500, {
+                    "success": False,
+                    "error": "Both AI models failed to generate a response.",
+                    "details": {
+                        "primary_model": _PRIMARY_MODEL,
+                        "primary_error": errors.get(_PRIMARY_MODEL),
+                        "fallback_model": _FALLBACK_MODEL,
+                        "fallback_error": errors.get(_FALLBACK_MODEL),
+                    },
+                    "hint": (
+                        "This may be a temporary issue with the Gemini API. "
+                        "Try again in a few seconds. If the problem persists, "
+                        "the API key may be invalid or have exceeded its quota."
+                    ),
+                })
+                return
 
             result = {
                 "success": True,
                 "response": response_text,
                 "model": used_model,
             }
-            if primary_error:
+            if used_model == _FALLBACK_MODEL:
                 result["fallback_used"] = True
             self._send_json(200, result)
 
         except Exception as e:
-            traceback.print_exc()
+            if _should_log((type(e).__name__, str(e)[:200])):
+                _log.exception("Gemini call failed")
             error_msg = str(e)
             hint = "An unexpected error occurred. Try again shortly."
 
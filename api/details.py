@@ -6,20 +6,158 @@ Fetches full details from original listing including all photos
 from http.server import BaseHTTPRequestHandler
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+import atexit
+import concurrent.futures
+import functools
+import logging
+import os
+import lxml.html
+from lxml.etree import XPath
 from urllib.parse import urlparse, parse_qs, urljoin
 import re
 import ipaddress
 import socket
+import threading
+import time
+from collections import OrderedDict
 
+from api.utils.aio import run_async
 from api.utils.response import cors_headers, send_json, send_options, error_response
 
+logging.basicConfig(level=logging.WARNING)
+_log = logging.getLogger("details")
+
+# Lives on the shared loop so its keep-alive connections survive across
+# warm invocations
+_session = None  # created lazily; see _get_session()
+_FETCH_TIMEOUT = 15  # seconds the handler waits for a fetch
+_DNS_CACHE_TTL = 300  # seconds a host's SSRF resolution check is reused
+_MAX_BATCH_URLS = 20  # listings per batch request (repeated url= params)
+_MAX_PAGE_BYTES = 1_000_000  # listing content sits well inside the first few hundred KB
+_READ_CHUNK_BYTES = 64 * 1024
+_fetch_slots = asyncio.Semaphore(64)  # in-flight listing fetches on the shared loop
+_host_slots = {}  # hostname -> BoundedSemaphore, so one site never sees a burst
+_PER_HOST_FETCHES = 8
+_RETRY_STATUSES = frozenset((429, 503))
+_MAX_RETRIES = 2
+_MAX_RETRY_DELAY = 4  # seconds; keeps retries inside _FETCH_TIMEOUT
+# HTML parsing off the shared loop, one thread per CPU this process may run on; lxml
+# drops the GIL while parsing, so more threads than that only queue
+_PARSE_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+_parse_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_PARSE_WORKERS)
+
+# Parsed details by listing URL; listings rarely change once posted
+_details_cache = OrderedDict()  # key: url -> (monotonic ts, details), LRU order
+_DETAILS_CACHE_TTL = 600  # 10 minutes
+_DETAILS_CACHE_MAX_ENTRIES = 1024
+
+_MAX_IMAGES = 20  # per listing, for the dealer sites with large galleries
+
+# Image URL size rewrites, thumbnail -> full size
+_CL_THUMB_SIZE_RE = re.compile(r'_\d+x\d+')
+_CARGURUS_SIZE_RE = re.compile(r'/\d+x\d+/')
+_AUTOTRADER_WIDTH_RE = re.compile(r'\?w=\d+')
+
+# XPath predicate matching one class among several, like soup.find(class_=...)
+_HAS_CLASS = 'contains(concat(" ", normalize-space(@class), " "), " {} ")'
+
+
+def _img_srcs(scope, *needles):
+    """Compiled XPath yielding each <img>'s src, else data-src, under scope.
+
+    With needles, only URLs containing one of them are returned. The
+    src-or-data-src choice and the filtering both happen inside libxml2.
+    """
+    def wanted(attr):
+        if not needles:
+            return f'{attr} != ""'
+        return ' or '.join(f'contains({attr}, "{needle}")' for needle in needles)
+
+    no_src = 'not(@src) or @src = ""'
+    return XPath(
+        f'{scope}//img[{wanted("@src")}]/@src'
+        f' | {scope}//img[({no_src}) and ({wanted("@data-src")})]/@data-src',
+        smart_strings=False,
+    )
+
+
+# Per-site lookups, compiled once and run straight from the document root so
+# only matching nodes ever get Python proxies
+
+# Craigslist lookups
+_CL_GALLERY_SRCS = XPath(f'(//div[{_HAS_CLASS.format("gallery")}])[1]//img/@src', smart_strings=False)
+_CL_THUMB_HREFS = XPath('(//div[@id="thumbs"])[1]//a/@href', smart_strings=False)
+_CL_SWIPE_SRCS = XPath(f'(//div[{_HAS_CLASS.format("swipe")}])[1]//img/@src', smart_strings=False)
+_CL_POSTING_BODY = XPath('(//section[@id="postingbody"])[1]')
+# Only "label: value" spans; the year/make/model title span has no colon
+_CL_ATTR_SPANS = XPath(
+    f'(//div[{_HAS_CLASS.format("mapAndAttrs")}])[1]//p[{_HAS_CLASS.format("attrgroup")}]//span[contains(., ":")]'
+)
+
+# CarGurus lookups
+_CG_GALLERY_SRCS = _img_srcs(f'(//div[{_HAS_CLASS.format("photoGallery")}])[1]', 'cargurus')
+_CG_PICTURE_SRCSETS = XPath('//picture//source/@srcset', smart_strings=False)
+_CG_DEALER_DESCRIPTION = XPath(f'(//div[{_HAS_CLASS.format("dealerDescription")}])[1]')
+_CG_SELLER_COMMENTS = XPath(f'(//div[{_HAS_CLASS.format("sellerComments")}])[1]')
+_CG_SPECS = XPath(f'(//dl[{_HAS_CLASS.format("listingDetails")}])[1]')
+
+# Cars.com lookups
+_CC_GALLERY_SRCS = _img_srcs(f'(//div[{_HAS_CLASS.format("media-gallery")}])[1]', 'cars.com')
+_CC_CAROUSEL_SRCS = _img_srcs(f'(//div[{_HAS_CLASS.format("image-carousel")}])[1]')
+_CC_DESCRIPTION = XPath(f'(//div[{_HAS_CLASS.format("seller-description")}])[1]')
+_CC_SPECS = XPath(f'(//dl[{_HAS_CLASS.format("fancy-description-list")}])[1]')
+
+# AutoTrader lookups
+_AT_IMG_SRCS = _img_srcs('', 'autotrader', 'atcdn')
+_AT_DESCRIPTION = XPath(f'(//div[{_HAS_CLASS.format("comments")}])[1]')
+
+# Spec label substring -> details key, tried in order, first match wins
+_CG_SPEC_RULES = (
+    ('transmission', 'transmission'),
+    ('fuel', 'fuel'),
+    ('drive', 'drive'),
+    ('color', 'color'),
+    ('exterior', 'color'),
+    ('interior', 'interior_color'),
+    ('mpg', 'mpg'),
+)
+_CC_SPEC_RULES = (
+    ('transmission', 'transmission'),
+    ('drivetrain', 'drive'),
+    ('fuel', 'fuel'),
+    ('exterior color', 'color'),
+    ('interior color', 'interior_color'),
+    ('mpg', 'mpg'),
+)
+
+# Spec list rows, relative to a <dl>
+_DESCENDANT_DTS = XPath('.//dt')
+_DESCENDANT_DDS = XPath('.//dd')
+
+# Craigslist attribute span label (text before the colon) -> details key
+_CL_ATTRS = {
+    'VIN': 'vin',
+    'condition': 'condition',
+    'cylinders': 'cylinders',
+    'drive': 'drive',
+    'fuel': 'fuel',
+    'title status': 'title_status',
+    'transmission': 'transmission',
+    'type': 'type',
+    'paint color': 'color',
+}
+
+_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+
 ALLOWED_DOMAINS = {
     'craigslist.org',
     'cargurus.com',
     'cars.com',
     'autotrader.com',
 }
+_ALLOWED_SUFFIXES = tuple('.' + domain for domain in ALLOWED_DOMAINS)
 
 
 def _is_url_allowed(url):
@@ -43,309 +181,394 @@ def _is_url_allowed(url):
             return False
 
     # Check hostname against allowed domains (supports subdomains)
-    domain_ok = any(
-        hostname == domain or hostname.endswith('.' + domain)
-        for domain in ALLOWED_DOMAINS
-    )
-    if not domain_ok:
+    if hostname not in ALLOWED_DOMAINS and not hostname.endswith(_ALLOWED_SUFFIXES):
         return False
 
-    # Block private/internal IPs
+    # Block allowed names that resolve to private/internal IPs. A raw IP can
+    # never match the domain allowlist above, so only DNS names get here.
     try:
-        addr = ipaddress.ip_address(hostname)
+        return _resolves_public(hostname, int(time.monotonic() // _DNS_CACHE_TTL))
+    except socket.gaierror:
+        return False
+
+
+@functools.lru_cache(maxsize=256)
+def _resolves_public(hostname, ttl_bucket):
+    """True if every address hostname resolves to is public.
+
+    ttl_bucket is only part of the cache key: it changes every _DNS_CACHE_TTL
+    seconds, so cached answers age out. Lookup failures raise and are not cached.
+    """
+    for entry in socket.getaddrinfo(hostname, None):
+        addr = ipaddress.ip_address(entry[4][0])
         if addr.is_private or addr.is_loopback or addr.is_reserved:
             return False
-    except ValueError:
-        # hostname is not a raw IP, resolve it
-        try:
-            resolved = socket.getaddrinfo(hostname, None)
-            for entry in resolved:
-                addr = ipaddress.ip_address(entry[4][0])
-                if addr.is_private or addr.is_loopback or addr.is_reserved:
-                    return False
-        except socket.gaierror:
-            return False
-
     return True
 
-class DetailsFetcher:
-    """Fetch detailed vehicle information from listing URLs"""
-    
-    def __init__(self):
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-    
-    async def fetch_craigslist_details(self, url, session):
-        """Extract all images and details from Craigslist listing"""
-        try:
-            async with session.get(url, headers=self.headers, timeout=10) as response:
-                if response.status != 200:
+
+def _cache_key(url):
+    """Details cache key: the URL with scheme and host lowercased.
+
+    Query and fragment are kept; some sites (CarGurus) carry the listing id there.
+    """
+    parsed = urlparse(url)
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower()).geturl()
+
+
+def _slots_for(hostname):
+    """Per-host fetch limiter; only touched from the shared loop, so no lock is needed"""
+    slots = _host_slots.get(hostname)
+    if slots is None:
+        slots = _host_slots[hostname] = asyncio.BoundedSemaphore(_PER_HOST_FETCHES)
+    return slots
+
+
+def _retry_delay(retry_after, attempt):
+    """Seconds to wait before retrying: Retry-After if given, else exponential"""
+    if retry_after and retry_after.strip().isdigit():
+        delay = int(retry_after)
+    else:
+        delay = 0.5 * 2 ** attempt
+    return min(delay, _MAX_RETRY_DELAY)
+
+
+async def _read_capped(response, limit=_MAX_PAGE_BYTES):
+    """Read at most limit bytes of a response body, in chunks.
+
+    Oversized pages are truncated rather than rejected; lxml recovers from
+    the cut-off markup and the rest is never downloaded.
+    """
+    buf = bytearray()
+    async for chunk in response.content.iter_chunked(_READ_CHUNK_BYTES):
+        buf.extend(chunk)
+        if len(buf) >= limit:
+            del buf[limit:]
+            break
+    return bytes(buf)
+
+
+_parser_local = threading.local()
+_MAX_PARSERS_PER_THREAD = 8  # charsets come from response headers
+
+
+def _html_parser(encoding):
+    """lxml HTML parser for a response charset, built once per charset per thread.
+
+    A parser instance only parses one document at a time, so sharing one
+    across _parse_pool would run the workers' parses one after another.
+    """
+    parsers = getattr(_parser_local, 'parsers', None)
+    if parsers is None:
+        parsers = _parser_local.parsers = {}
+    parser = parsers.get(encoding)
+    if parser is None:
+        if len(parsers) >= _MAX_PARSERS_PER_THREAD:
+            parsers.clear()
+        parser = parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+    return parser
+
+
+def _parse_html(raw, charset):
+    """Parse raw response bytes into an lxml document."""
+    return lxml.html.document_fromstring(raw, parser=_html_parser(charset or 'utf-8'))
+
+
+@functools.lru_cache(maxsize=256)
+def _spec_key(rules, label):
+    """details key for a lowercased spec label, resolved once per distinct label"""
+    for needle, key in rules:
+        if needle in label:
+            return key
+    return None
+
+
+def _add_capped(images, urls):
+    """Add urls to an insertion-ordered images set, stopping at _MAX_IMAGES.
+
+    urls may be a lazy generator, so rewrites for skipped images never run.
+    """
+    for url in urls:
+        if len(images) >= _MAX_IMAGES:
+            return
+        images[url] = None
+
+
+def _first(xpath, doc):
+    """First node a compiled XPath matches in doc, or None, like soup.find()."""
+    found = xpath(doc)
+    return found[0] if found else None
+
+
+def _text(el):
+    """Element text with runs of whitespace collapsed to single spaces.
+
+    text_content() keeps source indentation and line breaks, which would
+    leak into descriptions and stop indented spec labels matching a rule.
+    """
+    return " ".join(el.text_content().split())
+
+
+def _parse_craigslist(raw, charset):
+    """Extract all images and details from a Craigslist listing page"""
+    doc = _parse_html(raw, charset)
+
+    details = {}
+
+    # Extract all images
+    images = {}  # insertion-ordered set
+
+    # Method 1: Gallery images
+    for src in _CL_GALLERY_SRCS(doc):
+        if src:
+            # Convert thumbnail to full size
+            full_src = _CL_THUMB_SIZE_RE.sub('_600x450', src)
+            images[full_src] = None
+
+    # Method 2: Thumbnail container
+    for href in _CL_THUMB_HREFS(doc):
+        if href:
+            images[href] = None
+
+    # Method 3: Image swipe container
+    for src in _CL_SWIPE_SRCS(doc):
+        if src:
+            images[src] = None
+
+    details['images'] = list(images)
+    details['image_url'] = next(iter(images), None)
+
+    # Extract description
+    for desc_section in _CL_POSTING_BODY(doc):
+        # Remove "QR Code Link to This Post" text
+        for qr in desc_section.find_class('print-qrcode-container'):
+            qr.drop_tree()
+        details['description'] = _text(desc_section)
+
+    # Extract attributes
+    for span in _CL_ATTR_SPANS(doc):
+        # One dict lookup on the label instead of a prefix scan
+        label, _, value = _text(span).partition(':')
+        key = _CL_ATTRS.get(label)
+        if key:
+            details[key] = value.strip()
+
+    return details
+
+
+def _parse_cargurus(raw, charset):
+    """Extract all images and details from a CarGurus listing page"""
+    doc = _parse_html(raw, charset)
+
+    details = {}
+    images = {}  # insertion-ordered set
+
+    # Extract images from gallery
+    # High-res version of each gallery image
+    _add_capped(images, (_CARGURUS_SIZE_RE.sub('/640x480/', src) for src in _CG_GALLERY_SRCS(doc)))
+
+    # Alternative: Look for picture elements
+    for srcset in _CG_PICTURE_SRCSETS(doc):
+        if len(images) >= _MAX_IMAGES:
+            break
+        if srcset:
+            # Get largest image from srcset
+            _add_capped(images, (candidate.strip().split(' ')[0] for candidate in srcset.split(',')))
+
+    details['images'] = list(images)
+    details['image_url'] = next(iter(images), None)
+
+    # Extract description
+    desc = _first(_CG_DEALER_DESCRIPTION, doc)
+    if desc is None:
+        desc = _first(_CG_SELLER_COMMENTS, doc)
+    if desc is not None:
+        details['description'] = _text(desc)
+
+    # Extract specs
+    specs = _first(_CG_SPECS, doc)
+    if specs is not None:
+        dts = _DESCENDANT_DTS(specs)
+        dds = _DESCENDANT_DDS(specs)
+        for dt, dd in zip(dts, dds):
+            key = _spec_key(_CG_SPEC_RULES, _text(dt).lower())
+            if key:
+                details[key] = _text(dd)
+
+    return details
+
+
+def _parse_cars_com(raw, charset):
+    """Extract all images and details from a Cars.com listing page"""
+    doc = _parse_html(raw, charset)
+
+    details = {}
+    images = {}  # insertion-ordered set
+
+    # Extract images from media gallery
+    _add_capped(images, _CC_GALLERY_SRCS(doc))
+
+    # Look for picture carousel
+    _add_capped(images, _CC_CAROUSEL_SRCS(doc))
+
+    details['images'] = list(images)
+    details['image_url'] = next(iter(images), None)
+
+    # Extract description
+    desc = _first(_CC_DESCRIPTION, doc)
+    if desc is not None:
+        details['description'] = _text(desc)
+
+    # Extract key specs
+    specs = _first(_CC_SPECS, doc)
+    if specs is not None:
+        dts = _DESCENDANT_DTS(specs)
+        dds = _DESCENDANT_DDS(specs)
+        for dt, dd in zip(dts, dds):
+            key = _spec_key(_CC_SPEC_RULES, _text(dt).lower())
+            if key:
+                details[key] = _text(dd)
+
+    return details
+
+
+def _parse_autotrader(raw, charset):
+    """Extract all images and details from an AutoTrader listing page"""
+    doc = _parse_html(raw, charset)
+
+    details = {}
+    images = {}  # insertion-ordered set
+
+    # Extract images
+    # Full-size version of each image
+    _add_capped(images, (
+        _AUTOTRADER_WIDTH_RE.sub('?w=1920', src) if '?w=' in src else src
+        for src in _AT_IMG_SRCS(doc)
+    ))
+
+    details['images'] = list(images)
+    details['image_url'] = next(iter(images), None)
+
+    # Extract description
+    desc = _first(_AT_DESCRIPTION, doc)
+    if desc is not None:
+        details['description'] = _text(desc)
+
+    return details
+
+
+# Registered domain -> (page parser, site name for logs)
+_SITE_PARSERS = {
+    'craigslist.org': (_parse_craigslist, 'Craigslist'),
+    'cargurus.com': (_parse_cargurus, 'CarGurus'),
+    'cars.com': (_parse_cars_com, 'Cars.com'),
+    'autotrader.com': (_parse_autotrader, 'AutoTrader'),
+}
+
+
+async def _fetch_html(session, url):
+    """Download a listing page as (body bytes, charset), or None on a non-200.
+
+    Shared by every site: common headers and timeout, a per-host slot,
+    429/503 retries with backoff, and the body size cap.
+    """
+    slots = _slots_for(urlparse(url).hostname)
+    for attempt in range(_MAX_RETRIES + 1):
+        async with slots:
+            async with session.get(url, headers=_HEADERS, timeout=10) as response:
+                if response.status == 200:
+                    return await _read_capped(response), response.charset
+                if response.status not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
                     return None
-                
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                details = {}
-                
-                # Extract all images
-                images = []
-                
-                # Method 1: Gallery images
-                gallery = soup.find('div', {'class': 'gallery'})
-                if gallery:
-                    for img in gallery.find_all('img'):
-                        src = img.get('src')
-                        if src:
-                            # Convert thumbnail to full size
-                            full_src = re.sub(r'_\d+x\d+', '_600x450', src)
-                            images.append(full_src)
-                
-                # Method 2: Thumbnail container
-                thumbs = soup.find('div', {'id': 'thumbs'})
-                if thumbs:
-                    for link in thumbs.find_all('a'):
-                        href = link.get('href')
-                        if href:
-                            images.append(href)
-                
-                # Method 3: Image swipe container
-                swipe = soup.find('div', {'class': 'swipe'})
-                if swipe:
-                    for img in swipe.find_all('img'):
-                        src = img.get('src')
-                        if src and src not in images:
-                            images.append(src)
-                
-                details['images'] = list(set(images))  # Remove duplicates
-                details['image_url'] = images[0] if images else None
-                
-                # Extract description
-                desc_section = soup.find('section', {'id': 'postingbody'})
-                if desc_section:
-                    # Remove "QR Code Link to This Post" text
-                    for qr in desc_section.find_all('div', {'class': 'print-qrcode-container'}):
-                        qr.decompose()
-                    details['description'] = desc_section.get_text(strip=True)
-                
-                # Extract attributes
-                attrs = soup.find('div', {'class': 'mapAndAttrs'})
-                if attrs:
-                    attr_groups = attrs.find_all('p', {'class': 'attrgroup'})
-                    for group in attr_groups:
-                        for span in group.find_all('span'):
-                            text = span.get_text(strip=True)
-                            
-                            # Parse specific attributes
-                            if 'VIN:' in text:
-                                details['vin'] = text.replace('VIN:', '').strip()
-                            elif 'condition:' in text:
-                                details['condition'] = text.replace('condition:', '').strip()
-                            elif 'cylinders:' in text:
-                                details['cylinders'] = text.replace('cylinders:', '').strip()
-                            elif 'drive:' in text:
-                                details['drive'] = text.replace('drive:', '').strip()
-                            elif 'fuel:' in text:
-                                details['fuel'] = text.replace('fuel:', '').strip()
-                            elif 'title status:' in text:
-                                details['title_status'] = text.replace('title status:', '').strip()
-                            elif 'transmission:' in text:
-                                details['transmission'] = text.replace('transmission:', '').strip()
-                            elif 'type:' in text:
-                                details['type'] = text.replace('type:', '').strip()
-                            elif 'paint color:' in text:
-                                details['color'] = text.replace('paint color:', '').strip()
-                
-                return details
-                
-        except Exception as e:
-            print(f"Craigslist details error: {e}")
-            return None
-    
-    async def fetch_cargurus_details(self, url, session):
-        """Extract all images and details from CarGurus listing"""
+                delay = _retry_delay(response.headers.get('Retry-After'), attempt)
+        # Back off without holding the host's slot
+        await asyncio.sleep(delay)
+
+
+class DetailsFetcher:
+    """Fetch detailed vehicle information from listing URLs (stateless)"""
+
+    async def _fetch_and_parse(self, url, session, parse, site):
+        """Download a listing page, then parse it off the event loop"""
         try:
-            async with session.get(url, headers=self.headers, timeout=10) as response:
-                if response.status != 200:
-                    return None
-                
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                details = {}
-                images = []
-                
-                # Extract images from gallery
-                gallery = soup.find('div', {'class': 'photoGallery'})
-                if gallery:
-                    for img in gallery.find_all('img'):
-                        src = img.get('src') or img.get('data-src')
-                        if src and 'cargurus' in src:
-                            # Get high-res version
-                            high_res = re.sub(r'/\d+x\d+/', '/640x480/', src)
-                            images.append(high_res)
-                
-                # Alternative: Look for picture elements
-                for picture in soup.find_all('picture'):
-                    for source in picture.find_all('source'):
-                        srcset = source.get('srcset')
-                        if srcset:
-                            # Get largest image from srcset
-                            urls = [url.strip().split(' ')[0] for url in srcset.split(',')]
-                            images.extend(urls)
-                
-                details['images'] = list(set(images))[:20]  # Limit to 20 images
-                details['image_url'] = images[0] if images else None
-                
-                # Extract description
-                desc = soup.find('div', {'class': 'dealerDescription'})
-                if not desc:
-                    desc = soup.find('div', {'class': 'sellerComments'})
-                if desc:
-                    details['description'] = desc.get_text(strip=True)
-                
-                # Extract specs
-                specs = soup.find('dl', {'class': 'listingDetails'})
-                if specs:
-                    dts = specs.find_all('dt')
-                    dds = specs.find_all('dd')
-                    for dt, dd in zip(dts, dds):
-                        key = dt.get_text(strip=True).lower()
-                        value = dd.get_text(strip=True)
-                        
-                        if 'transmission' in key:
-                            details['transmission'] = value
-                        elif 'fuel' in key:
-                            details['fuel'] = value
-                        elif 'drive' in key:
-                            details['drive'] = value
-                        elif 'color' in key or 'exterior' in key:
-                            details['color'] = value
-                        elif 'interior' in key:
-                            details['interior_color'] = value
-                        elif 'mpg' in key:
-                            details['mpg'] = value
-                
-                return details
-                
+            page = await _fetch_html(session, url)
+            if page is None:
+                return None
+
+            # lxml releases the GIL while parsing, so other fetches keep moving
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_parse_pool, parse, *page)
+
         except Exception as e:
-            print(f"CarGurus details error: {e}")
+            _log.warning("%s details error: %s", site, e)
             return None
-    
-    async def fetch_cars_com_details(self, url, session):
-        """Extract all images and details from Cars.com listing"""
-        try:
-            async with session.get(url, headers=self.headers, timeout=10) as response:
-                if response.status != 200:
-                    return None
-                
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                details = {}
-                images = []
-                
-                # Extract images from media gallery
-                gallery = soup.find('div', {'class': 'media-gallery'})
-                if gallery:
-                    for img in gallery.find_all('img'):
-                        src = img.get('src') or img.get('data-src')
-                        if src and 'cars.com' in src:
-                            images.append(src)
-                
-                # Look for picture carousel
-                carousel = soup.find('div', {'class': 'image-carousel'})
-                if carousel:
-                    for img in carousel.find_all('img'):
-                        src = img.get('src') or img.get('data-src')
-                        if src:
-                            images.append(src)
-                
-                details['images'] = list(set(images))[:20]
-                details['image_url'] = images[0] if images else None
-                
-                # Extract description
-                desc = soup.find('div', {'class': 'seller-description'})
-                if desc:
-                    details['description'] = desc.get_text(strip=True)
-                
-                # Extract key specs
-                specs = soup.find('dl', {'class': 'fancy-description-list'})
-                if specs:
-                    dts = specs.find_all('dt')
-                    dds = specs.find_all('dd')
-                    for dt, dd in zip(dts, dds):
-                        key = dt.get_text(strip=True).lower()
-                        value = dd.get_text(strip=True)
-                        
-                        if 'transmission' in key:
-                            details['transmission'] = value
-                        elif 'drivetrain' in key:
-                            details['drive'] = value
-                        elif 'fuel' in key:
-                            details['fuel'] = value
-                        elif 'exterior color' in key:
-                            details['color'] = value
-                        elif 'interior color' in key:
-                            details['interior_color'] = value
-                        elif 'mpg' in key:
-                            details['mpg'] = value
-                
-                return details
-                
-        except Exception as e:
-            print(f"Cars.com details error: {e}")
+
+    async def fetch_details(self, url, session):
+        """Return cached details for url, or fetch and cache them"""
+        key = _cache_key(url)
+        now = time.monotonic()
+        entry = _details_cache.get(key)
+        if entry is not None:
+            if now - entry[0] < _DETAILS_CACHE_TTL:
+                _details_cache.move_to_end(key)
+                return entry[1]
+            del _details_cache[key]
+
+        details = await self._dispatch(url, session)
+        if details:
+            _details_cache[key] = (now, details)
+            if len(_details_cache) > _DETAILS_CACHE_MAX_ENTRIES:
+                _details_cache.popitem(last=False)
+        return details
+
+    async def _dispatch(self, url, session):
+        """Route to the parser for the URL's site"""
+        hostname = urlparse(url).hostname or ''
+        site = _SITE_PARSERS.get('.'.join(hostname.rsplit('.', 2)[-2:]))
+        if site is None:
             return None
-    
-    async def fetch_autotrader_details(self, url, session):
-        """Extract all images and details from AutoTrader listing"""
+        parse, name = site
+        return await self._fetch_and_parse(url, session, parse, name)
+
+    async def fetch_many(self, urls, session):
+        """Fetch several listings concurrently; results line up with urls"""
+        async def bounded(url):
+            async with _fetch_slots:
+                return await self.fetch_details(url, session)
+
+        return await asyncio.gather(*(bounded(url) for url in urls), return_exceptions=True)
+
+
+def _get_session():
+    """Return the shared ClientSession, creating it on first use. Runs on the shared loop."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=75),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+    return _session
+
+
+def _close_session():
+    """Close the shared session on interpreter exit so connections shut cleanly"""
+    if _session is not None and not _session.closed:
         try:
-            async with session.get(url, headers=self.headers, timeout=10) as response:
-                if response.status != 200:
-                    return None
-                
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                details = {}
-                images = []
-                
-                # Extract images
-                for img in soup.find_all('img'):
-                    src = img.get('src') or img.get('data-src')
-                    if src and ('autotrader' in src or 'atcdn' in src):
-                        # Get full-size image
-                        if '?w=' in src:
-                            src = re.sub(r'\?w=\d+', '?w=1920', src)
-                        images.append(src)
-                
-                details['images'] = list(set(images))[:20]
-                details['image_url'] = images[0] if images else None
-                
-                # Extract description
-                desc = soup.find('div', {'class': 'comments'})
-                if desc:
-                    details['description'] = desc.get_text(strip=True)
-                
-                return details
-                
+            run_async(_session.close(), timeout=2)
         except Exception as e:
-            print(f"AutoTrader details error: {e}")
-            return None
-    
-    async def fetch_details(self, url):
-        """Route to appropriate fetcher based on URL"""
-        async with aiohttp.ClientSession() as session:
-            if 'craigslist.org' in url:
-                return await self.fetch_craigslist_details(url, session)
-            elif 'cargurus.com' in url:
-                return await self.fetch_cargurus_details(url, session)
-            elif 'cars.com' in url:
-                return await self.fetch_cars_com_details(url, session)
-            elif 'autotrader.com' in url:
-                return await self.fetch_autotrader_details(url, session)
-            else:
-                return None
+            _log.warning("session close error: %s", e)
+
+
+atexit.register(_close_session)
+
+_fetcher = DetailsFetcher()
+
+
+async def _fetch_details(url):
+    return await _fetcher.fetch_details(url, _get_session())
+
+
+async def _fetch_many(urls):
+    return await _fetcher.fetch_many(urls, _get_session())
 
 
 class handler(BaseHTTPRequestHandler):
@@ -355,24 +578,33 @@ class handler(BaseHTTPRequestHandler):
             parsed = urlparse(self.path)
             params = parse_qs(parsed.query)
             
-            url = params.get('url', [None])[0]
-            
-            if not url:
+            urls = [u for u in params.get('url', []) if u]
+
+            if not urls:
                 send_json(self, 400, error_response('Missing url parameter'))
                 return
+            if len(urls) > _MAX_BATCH_URLS:
+                send_json(self, 400, error_response(f'Too many url parameters (limit {_MAX_BATCH_URLS})'))
+                return
 
             # SSRF protection: validate URL before fetching
-            if not _is_url_allowed(url):
-                send_json(self, 400, error_response('URL not allowed. Only Craigslist, CarGurus, Cars.com, and AutoTrader URLs are supported.'))
+            for url in urls:
+                if not _is_url_allowed(url):
+                    send_json(self, 400, error_response('URL not allowed. Only Craigslist, CarGurus, Cars.com, and AutoTrader URLs are supported.'))
+                    return
+
+            if len(urls) > 1:
+                self._send_batch(urls)
+                return
+            url = urls[0]
+
+            # Fetch details on the shared loop
+            try:
+                details = run_async(_fetch_details(url), timeout=_FETCH_TIMEOUT)
+            except TimeoutError:
+                send_json(self, 504, error_response('Timed out fetching listing details'))
                 return
 
-            # Fetch details
-            fetcher = DetailsFetcher()
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            details = loop.run_until_complete(fetcher.fetch_details(url))
-            loop.close()
-            
             if details:
                 send_json(self, 200, {
                     'success': True,
@@ -384,6 +616,26 @@ class handler(BaseHTTPRequestHandler):
         except Exception as e:
             send_json(self, 500, error_response(str(e)))
 
+    def _send_batch(self, urls):
+        """Fetch several listings at once and return one result per URL, in order."""
+        try:
+            fetched = run_async(_fetch_many(urls), timeout=_FETCH_TIMEOUT)
+        except TimeoutError:
+            send_json(self, 504, error_response('Timed out fetching listing details'))
+            return
+
+        results = []
+        for url, details in zip(urls, fetched):
+            if details and not isinstance(details, BaseException):
+                results.append({'url': url, 'success': True, 'details': details})
+            else:
+                results.append({'url': url, 'success': False, 'error': 'Failed to fetch details'})
+
+        send_json(self, 200, {
+            'success': any(r['success'] for r in results),
+            'results': results,
+        })
+
     def do_OPTIONS(self):
         """Handle CORS preflight requests."""
         send_options(self)
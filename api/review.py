@@ -6,100 +6,268 @@ owner sentiment, recall info, and insurance estimates.
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
+import functools
+import logging
 import os
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+import urllib3
+
+from api.utils.hedge import race
+from api.utils.response import encode_json
+
+logging.basicConfig(level=logging.WARNING)
+_log = logging.getLogger("review")
 
 # ---------------------------------------------------------------------------
-# In-memory cache: keyed by "make_model_year"
+# Review cache: keyed by make, model, year and price/mileage bucket
+# An in-memory LRU in front of a SQLite file in the temp dir, so reviews
+# survive a cold start on the same instance. Timestamps are wall-clock
+# because the file outlives the process.
 # ---------------------------------------------------------------------------
-_review_cache = {}
+_review_cache = OrderedDict()  # key -> (created_at, review), LRU order
+_REVIEW_CACHE_TTL = 7 * 24 * 3600  # 7 days
+_REVIEW_CACHE_MAX_ENTRIES = 256
+# The price verdict depends on the asking price and mileage, so reviews are
+# only shared between listings that fall in the same bucket of each
+_PRICE_BUCKET = 1000  # dollars
+_MILEAGE_BUCKET = 10000  # miles
+_cache_lock = threading.Lock()  # guards _review_cache; _db_lock guards the file
+_REVIEW_DB_PATH = os.path.join(tempfile.gettempdir(), "reviews.db")
+_REVIEW_DB_MAX_ROWS = 5000  # keys are client-supplied, so the file needs a cap
+_DB_SWEEP_EVERY = 64  # prune expired and excess rows every N writes
+_db_writes_since_sweep = 0
+_db = None  # opened lazily; see _review_db()
+_db_lock = threading.Lock()
+
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*\n?(.*?)\n?\s*```", re.DOTALL)
+_JSON_BRACE_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+_MAX_BODY_BYTES = 8 * 1024  # make/model/year/price/mileage/source fit in well under 1 KB
 
 PRIMARY_MODEL = "gemini-2.5-flash"
 FALLBACK_MODEL = "gemini-2.5-flash-lite"  # 2.0-flash deprecated March 2026
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+_HEDGE_AFTER = 3.0  # seconds before the fallback model is raced against the primary
+
+# Keep-alive connection pool to the Gemini API, reused across warm
+# invocations. Rate limits and transient 5xx get two retries with
+# exponential backoff before the next model is tried.
+_http = urllib3.PoolManager(
+    num_pools=2,
+    maxsize=8,
+    timeout=urllib3.Timeout(connect=5, read=30),
+    retries=urllib3.Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+)
+
+
+def _review_db():
+    """Return the shared SQLite connection, creating the table on first use."""
+    global _db
+    if _db is None:
+        conn = sqlite3.connect(_REVIEW_DB_PATH, timeout=1, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reviews "
+            "(key TEXT PRIMARY KEY, json TEXT NOT NULL, created_at INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS reviews_created_at ON reviews (created_at)")
+        _db = conn
+    return _db
+
+
+def _cache_key(make, model, year, price, mileage):
+    """Cache key for a review of this car at roughly this price and mileage."""
+    return f"{make}_{model}_{year}_{price // _PRICE_BUCKET}_{mileage // _MILEAGE_BUCKET}".lower()
+
+
+def _cache_get(key):
+    """Return a fresh cached review from memory, then disk, or None."""
+    now = time.time()
+    with _cache_lock:
+        entry = _review_cache.get(key)
+        if entry is not None:
+            if now - entry[0] < _REVIEW_CACHE_TTL:
+                _review_cache.move_to_end(key)
+                return entry[1]
+            del _review_cache[key]
+
+    try:
+        with _db_lock:
+            row = _review_db().execute(
+                "SELECT json, created_at FROM reviews WHERE key = ? AND created_at > ?",
+                (key, int(now - _REVIEW_CACHE_TTL)),
+            ).fetchone()
+    except sqlite3.Error as e:
+        _log.warning("review cache read failed: %s", e)
+        return None
+    if row is None:
+        return None
+
+    try:
+        review = orjson.loads(row[0])
+    except orjson.JSONDecodeError as e:
+        # A damaged row is a cache fault, not a bad request; regenerate it
+        _log.warning("review cache row for %r is corrupt: %s", key, e)
+        return None
+    _cache_remember(key, review, row[1])
+    return review
+
+
+def _cache_remember(key, review, created_at):
+    with _cache_lock:
+        _review_cache[key] = (created_at, review)
+        _review_cache.move_to_end(key)
+        if len(_review_cache) > _REVIEW_CACHE_MAX_ENTRIES:
+            _review_cache.popitem(last=False)
+
+
+def _sweep_db(db, now):
+    """Delete expired rows, then the oldest beyond _REVIEW_DB_MAX_ROWS. Caller holds _db_lock."""
+    db.execute("DELETE FROM reviews WHERE created_at <= ?", (int(now - _REVIEW_CACHE_TTL),))
+    db.execute(
+        "DELETE FROM reviews WHERE key IN "
+        "(SELECT key FROM reviews ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (_REVIEW_DB_MAX_ROWS,),
+    )
+
+
+def _cache_put(key, review):
+    """Store a review in memory and on disk; disk errors only cost the cache."""
+    global _db_writes_since_sweep
+    created_at = int(time.time())
+    _cache_remember(key, review, created_at)
+    try:
+        with _db_lock:
+            db = _review_db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO reviews (key, json, created_at) VALUES (?, ?, ?)",
+                    (key, orjson.dumps(review).decode(), created_at),
+                )
+                _db_writes_since_sweep += 1
+                if _db_writes_since_sweep >= _DB_SWEEP_EVERY:
+                    _db_writes_since_sweep = 0
+                    _sweep_db(db, created_at)
+    except sqlite3.Error as e:
+        _log.warning("review cache write failed: %s", e)
+
+
+_PROMPT_TEMPLATE = """You are an expert automotive analyst. Provide a detailed review of a {year} {make} {model} that is listed at ${price:,} with {mileage:,} miles.
+
+In addition to standard review content, please also incorporate:
+- What real owners commonly report about this vehicle based on Consumer Reports, Reddit (r/whatcarshouldIbuy, r/MechanicAdvice, r/cars), and enthusiast forums. Summarize the general owner sentiment.
+- Whether there are any active or recent NHTSA recalls for the {year} {make} {model}. List specific recall campaigns if known, otherwise state that the buyer should check NHTSA.gov.
+- An estimate of annual insurance costs for this vehicle (ballpark range for an average driver in the Milwaukee, WI area).
+{source_context}
+
+Respond ONLY with valid JSON (no markdown fencing, no extra text). The JSON object must have exactly these keys:
+
+- "summary": 2-3 sentence overview of this vehicle
+- "pros": array of 4-6 strings, each a specific pro with detail
+- "cons": array of 3-5 strings, each a specific con with detail
+- "reliability_rating": number from 1 to 5 (5 = most reliable)
+- "reliability_summary": 1-2 sentences on reliability for this make/model/year
+- "owner_sentiment": a paragraph summarizing what real owners say on forums, Reddit, and Consumer Reports — common praises and complaints
+- "fair_price_assessment": a paragraph assessing whether ${price:,} with {mileage:,} miles is a good deal compared to typical market prices
+- "price_verdict": exactly one of: "great_deal", "good_deal", "fair", "above_market", "overpriced"
+- "known_issues": array of common problems for this make/model/year range
+- "recall_info": a paragraph about any known active NHTSA recalls for the {year} {make} {model}, or a note to check NHTSA.gov if uncertain
+- "insurance_estimate": estimated annual insurance cost range (e.g. "$1,200 - $1,800/year") with brief explanation of factors
+- "cost_to_own_notes": brief notes on maintenance, insurance, and fuel costs
+- "platform_notes": brief note on the listing platform's reputation and tips for buying from it (or null if no platform was specified)
+"""
+
+_SOURCE_CONTEXT_TEMPLATE = (
+    "\n\nThe listing is from {source}. Include a brief note about the "
+    "reputation and trustworthiness of buying from {source} as a platform "
+    "(e.g. buyer protections, common scams to watch for, dealer vs private "
+    "seller norms on that platform)."
+)
+
 
 def _build_prompt(make, model, year, price, mileage, source=None):
     """Build the Gemini prompt requesting a structured JSON vehicle review."""
-    source_context = ""
-    if source:
-        source_context = (
-            f"\n\nThe listing is from {source}. Include a brief note about the "
-            f"reputation and trustworthiness of buying from {source} as a platform "
-            f"(e.g. buyer protections, common scams to watch for, dealer vs private "
-            f"seller norms on that platform)."
-        )
-
-    return (
-        f"You are an expert automotive analyst. Provide a detailed review of a "
-        f"{year} {make} {model} that is listed at ${price:,} with {mileage:,} miles.\n\n"
-        f"In addition to standard review content, please also incorporate:\n"
-        f"- What real owners commonly report about this vehicle based on Consumer Reports, "
-        f"Reddit (r/whatcarshouldIbuy, r/MechanicAdvice, r/cars), and enthusiast forums. "
-        f"Summarize the general owner sentiment.\n"
-        f"- Whether there are any active or recent NHTSA recalls for the {year} {make} {model}. "
-        f"List specific recall campaigns if known, otherwise state that the buyer should check "
-        f"NHTSA.gov.\n"
-        f"- An estimate of annual insurance costs for this vehicle (ballpark range for an "
-        f"average driver in the Milwaukee, WI area).\n"
-        f"{source_context}\n\n"
-        f"Respond ONLY with valid JSON (no markdown fencing, no extra text). "
-        f"The JSON object must have exactly these keys:\n\n"
-        f"- \"summary\": 2-3 sentence overview of this vehicle\n"
-        f"- \"pros\": array of 4-6 strings, each a specific pro with detail\n"
-        f"- \"cons\": array of 3-5 strings, each a specific con with detail\n"
-        f"- \"reliability_rating\": number from 1 to 5 (5 = most reliable)\n"
-        f"- \"reliability_summary\": 1-2 sentences on reliability for this make/model/year\n"
-        f"- \"owner_sentiment\": a paragraph summarizing what real owners say on forums, "
-        f"Reddit, and Consumer Reports — common praises and complaints\n"
-        f"- \"fair_price_assessment\": a paragraph assessing whether ${price:,} with "
-        f"{mileage:,} miles is a good deal compared to typical market prices\n"
-        f"- \"price_verdict\": exactly one of: \"great_deal\", \"good_deal\", \"fair\", "
-        f"\"above_market\", \"overpriced\"\n"
-        f"- \"known_issues\": array of common problems for this make/model/year range\n"
-        f"- \"recall_info\": a paragraph about any known active NHTSA recalls for the "
-        f"{year} {make} {model}, or a note to check NHTSA.gov if uncertain\n"
-        f"- \"insurance_estimate\": estimated annual insurance cost range (e.g. \"$1,200 - $1,800/year\") "
-        f"with brief explanation of factors\n"
-        f"- \"cost_to_own_notes\": brief notes on maintenance, insurance, and fuel costs\n"
-        f"- \"platform_notes\": brief note on the listing platform's reputation and tips "
-        f"for buying from it (or null if no platform was specified)\n"
+    source_context = _SOURCE_CONTEXT_TEMPLATE.format(source=source) if source else ""
+    return _PROMPT_TEMPLATE.format(
+        make=make,
+        model=model,
+        year=year,
+        price=price,
+        mileage=mileage,
+        source_context=source_context,
     )
 
 
+@functools.lru_cache(maxsize=1024)
 def _build_sources(make, model, year):
-    """Construct reference links from static URL patterns."""
+    """Construct reference links from static URL patterns.
+
+    Returns immutable (name, url) pairs so the result can be cached; the
+    handler turns them into dicts for the response.
+    """
     make_lower = make.lower().replace(" ", "-")
     model_lower = model.lower().replace(" ", "-")
     make_upper = make.upper().replace(" ", "+")
     model_upper = model.upper().replace(" ", "+")
 
-    return [
-        {
-            "name": "Edmunds",
-            "url": f"https://www.edmunds.com/{make_lower}/{model_lower}/{year}/review/",
-        },
-        {
-            "name": "Kelley Blue Book",
-            "url": f"https://www.kbb.com/{make_lower}/{model_lower}/{year}/",
-        },
-        {
-            "name": "Car and Driver",
-            "url": f"https://www.caranddriver.com/{make_lower}/{model_lower}/",
-        },
-        {
-            "name": "Consumer Reports",
-            "url": f"https://www.consumerreports.org/cars/{make_lower}/{model_lower}/",
-        },
-        {
-            "name": "NHTSA Recalls",
-            "url": f"https://www.nhtsa.gov/vehicle/{year}/{make_upper}/{model_upper}",
-        },
-        {
-            "name": "Reddit - r/whatcarshouldIbuy",
-            "url": f"https://www.reddit.com/r/whatcarshouldIbuy/search/?q={make}+{model}+{year}",
-        },
-    ]
+    return (
+        ("Edmunds", f"https://www.edmunds.com/{make_lower}/{model_lower}/{year}/review/"),
+        ("Kelley Blue Book", f"https://www.kbb.com/{make_lower}/{model_lower}/{year}/"),
+        ("Car and Driver", f"https://www.caranddriver.com/{make_lower}/{model_lower}/"),
+        ("Consumer Reports", f"https://www.consumerreports.org/cars/{make_lower}/{model_lower}/"),
+        ("NHTSA Recalls", f"https://www.nhtsa.gov/vehicle/{year}/{make_upper}/{model_upper}"),
+        (
+            "Reddit - r/whatcarshouldIbuy",
+            f"https://www.reddit.com/r/whatcarshouldIbuy/search/?q={make}+{model}+{year}",
+        ),
+    )
+
+
+def _extract_json_object(text):
+    """Return the first balanced {...} block in text, or None.
+
+    A single forward scan that skips braces inside JSON string literals, so
+    prose or a second object after the review doesn't end up in the slice.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
 
 
 def _parse_gemini_response(text):
@@ -108,82 +276,86 @@ def _parse_gemini_response(text):
 
     # Try direct parse first
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         pass
 
     # Strip markdown code fences if present
-    fenced = re.search(r"```(?:json)?\s*\n?(.*?)\n?\s*```", text, re.DOTALL)
+    fenced = _JSON_FENCE_RE.search(text)
     if fenced:
         try:
-            return json.loads(fenced.group(1).strip())
-        except json.JSONDecodeError:
+            return orjson.loads(fenced.group(1).strip())
+        except orjson.JSONDecodeError:
+            pass
+
+    # Try the first balanced { ... } block
+    candidate = _extract_json_object(text)
+    if candidate:
+        try:
+            return orjson.loads(candidate)
+        except orjson.JSONDecodeError:
             pass
 
-    # Try to find first { ... } block
-    brace_match = re.search(r"\{.*\}", text, re.DOTALL)
+    # Last resort: everything from the first { to the last }
+    brace_match = _JSON_BRACE_RE.search(text)
     if brace_match:
         try:
-            return json.loads(brace_match.group(0))
-        except json.JSONDecodeError:
+            return orjson.loads(brace_match.group(0))
+        except orjson.JSONDecodeError:
             pass
 
     raise ValueError("Could not parse JSON from Gemini response")
 
 
-def _call_gemini(prompt, api_key):
-    """Call Gemini REST API with model fallback and return parsed JSON review.
-
-    Uses direct HTTP requests (no SDK dependency). Tries the primary model
-    first. If it fails, falls back to the secondary model.
-    """
-    import urllib.request
-    import urllib.error
+def _try_model(model_name, api_key, payload):
+    """Run one model and return its parsed review; raises on failure."""
+    url = (
+        f"https://generativelanguage.googleapis.com/v1beta/"
+        f"models/{model_name}:generateContent?key={api_key}"
+    )
 
-    models_to_try = [PRIMARY_MODEL, FALLBACK_MODEL]
-    last_exception = None
+    resp = _http.request("POST", url, body=payload, headers=_JSON_HEADERS)
+    if resp.status != 200:
+        raise RuntimeError(f"HTTP {resp.status} from {model_name}")
+    body = orjson.loads(resp.data)
 
-    for model_name in models_to_try:
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/"
-            f"models/{model_name}:generateContent?key={api_key}"
-        )
-        payload = json.dumps({
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 4096,
-            },
-        }).encode()
+    text = (
+        body.get("candidates", [{}])[0]
+        .get("content", {})
+        .get("parts", [{}])[0]
+        .get("text", "")
+    )
 
-        req = urllib.request.Request(
-            url,
-            data=payload,
-            headers={"Content-Type": "application/json"},
-            method="POST",
-        )
+    if not text:
+        raise ValueError(f"Empty response from {model_name}")
 
-        try:
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                body = json.loads(resp.read().decode())
+    return _parse_gemini_response(text)
 
-            text = (
-                body.get("candidates", [{}])[0]
-                .get("content", {})
-                .get("parts", [{}])[0]
-                .get("text", "")
-            )
 
-            if not text:
-                last_exception = ValueError(f"Empty response from {model_name}")
-                continue
+def _call_gemini(prompt, api_key):
+    """Call Gemini REST API with model fallback and return parsed JSON review.
 
-            return _parse_gemini_response(text)
-        except Exception as e:
-            last_exception = e
-            continue
+    Uses direct HTTP requests (no SDK dependency). The primary model starts
+    immediately; the fallback is launched once the primary fails or has been
+    running for _HEDGE_AFTER seconds, and the first successful answer wins.
+    """
+    # The request body is identical for every model, so encode it once
+    payload = orjson.dumps({
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {
+            "temperature": 0.7,
+            "maxOutputTokens": 4096,
+        },
+    })
 
-    raise last_exception
+    attempts = [
+        (name, functools.partial(_try_model, name, api_key, payload))
+        for name in (PRIMARY_MODEL, FALLBACK_MODEL)
+    ]
+    winner, review, errors = race(attempts, _HEDGE_AFTER)
+    if winner is None:
+        raise list(errors.values())[-1]
+    return review
 
 
 # ---------------------------------------------------------------------------
@@ -197,11 +369,14 @@ class handler(BaseHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
 
     def _json_response(self, status, data):
+        body, headers = encode_json(self, data)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        for k, v in headers:
+            self.send_header(k, v)
         self._cors_headers()
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -219,11 +394,25 @@ class handler(BaseHTTPRequestHandler):
         })
 
     def do_POST(self):
+        # Reject oversize bodies before reading them
         try:
-            # Parse request body
             length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(length).decode("utf-8") if length > 0 else "{}"
-            data = json.loads(body)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self._json_response(400, {"success": False, "error": "Invalid Content-Length header."})
+            return
+        if length > _MAX_BODY_BYTES:
+            self._json_response(413, {
+                "success": False,
+                "error": f"Request body too large (limit {_MAX_BODY_BYTES // 1024} KB).",
+            })
+            return
+
+        try:
+            # Parse request body
+            body = self.rfile.read(length) if length > 0 else b"{}"
+            data = orjson.loads(body)
 
             make = data.get("make", "").strip()
             model = data.get("model", "").strip()
@@ -273,17 +462,16 @@ class handler(BaseHTTPRequestHandler):
                 return
 
             # Check cache
-            cache_key = f"{make}_{model}_{year}".lower()
-            cached = cache_key in _review_cache
+            cache_key = _cache_key(make, model, year, price, mileage)
+            review = _cache_get(cache_key)
+            cached = review is not None
 
-            if cached:
-                review = _review_cache[cache_key]
-            else:
+            if not cached:
                 prompt = _build_prompt(make, model, year, price, mileage, source)
                 review = _call_gemini(prompt, api_key)
-                _review_cache[cache_key] = review
+                _cache_put(cache_key, review)
 
-            sources = _build_sources(make, model, year)
+            sources = [{"name": name, "url": url} for name, url in _build_sources(make, model, year)]
 
             self._json_response(200, {
                 "success": True,
@@ -292,7 +480,7 @@ class handler(BaseHTTPRequestHandler):
                 "cached": cached,
             })
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             self._json_response(400, {
                 "success": False,
                 "error": "Invalid JSON in request body.",
@@ -4,35 +4,105 @@ Fetches safety ratings, recalls, and complaints from the free NHTSA API.
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
 import asyncio
 import aiohttp
-from urllib.parse import urlparse, parse_qs, quote
+import atexit
+import orjson
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, quote, urlencode
+
+from api.utils.aio import run_async
+from api.utils.response import encode_json
 
 # In-memory cache keyed by "{make}_{model}_{year}"
-_cache = {}
+_cache = OrderedDict()  # key -> (monotonic ts, result), LRU order
+_CACHE_TTL = 24 * 3600  # NHTSA data changes rarely; a day keeps recalls current
+_CACHE_MAX_ENTRIES = 512
+_cache_lock = threading.Lock()
+
+# Top-level keys a client may pick with ?fields=; "success" is always sent.
+# Complaint summaries dominate the payload, so callers that only show counts
+# can leave "complaints" out.
+_RESULT_FIELDS = frozenset((
+    "safety", "recalls", "recall_count", "complaints", "complaint_count", "nhtsa_url",
+))
 
 TIMEOUT = aiohttp.ClientTimeout(total=12)
 
+# Lives on the shared loop so its keep-alive connections to api.nhtsa.gov
+# survive across warm invocations. aiohttp speaks HTTP/1.1 only, so the three
+# lookups in _get_safety_data each take a pooled connection; those TLS
+# handshakes are paid once per warm process, not once per request.
+_session = None  # created lazily; see _get_session()
+_SAFETY_TIMEOUT = 25  # seconds the handler waits; inside the 30s maxDuration
 
-def _cors_headers():
-    return {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'GET, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
-    }
+
+def _get_session():
+    """Return the shared ClientSession, creating it on first use. Runs on the shared loop."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=128,
+                limit_per_host=32,  # every lookup targets api.nhtsa.gov
+                ttl_dns_cache=3600,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True,
+            ),
+            timeout=TIMEOUT,
+        )
+    return _session
+
+
+def _close_session():
+    """Close the shared session on interpreter exit so connections shut cleanly"""
+    if _session is not None and not _session.closed:
+        try:
+            run_async(_session.close(), timeout=2)
+        except Exception:
+            pass
+
+
+atexit.register(_close_session)
 
 
-async def _fetch_safety_ratings(session, year, make, model):
+def _cache_get(key):
+    """Return a fresh cached result, or None."""
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] < _CACHE_TTL:
+            _cache.move_to_end(key)
+            return entry[1]
+        del _cache[key]
+        return None
+
+
+def _cache_put(key, result):
+    with _cache_lock:
+        _cache[key] = (time.monotonic(), result)
+        _cache.move_to_end(key)
+        if len(_cache) > _CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+_CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type'),
+)
+
+
+async def _fetch_safety_ratings(session, path):
     """Fetch overall safety ratings from NHTSA SafetyRatings API."""
-    url = (
-        f"https://api.nhtsa.gov/SafetyRatings/modelyear/{quote(str(year))}"
-        f"/make/{quote(make)}/model/{quote(model)}?format=json"
-    )
+    url = f"https://api.nhtsa.gov/SafetyRatings/{path}?format=json"
     async with session.get(url, timeout=TIMEOUT) as resp:
         if resp.status != 200:
             return None
-        data = await resp.json(content_type=None)
+        data = orjson.loads(await resp.read())
         results = data.get("Results", [])
         if not results:
             return None
@@ -52,64 +122,66 @@ async def _fetch_safety_ratings(session, year, make, model):
         return None
 
 
-async def _fetch_recalls(session, year, make, model):
+async def _fetch_recalls(session, query):
     """Fetch recall data from NHTSA Recalls API."""
-    url = (
-        f"https://api.nhtsa.gov/recalls/recallsByVehicle"
-        f"?make={quote(make)}&model={quote(model)}&modelYear={quote(str(year))}"
-    )
+    url = f"https://api.nhtsa.gov/recalls/recallsByVehicle?{query}"
     async with session.get(url, timeout=TIMEOUT) as resp:
         if resp.status != 200:
             return []
-        data = await resp.json(content_type=None)
-        results = data.get("results", [])
-        recalls = []
-        for r in results:
-            recalls.append({
+        data = orjson.loads(await resp.read())
+        return [
+            {
                 "date": r.get("ReportReceivedDate", ""),
                 "component": r.get("Component", ""),
                 "summary": r.get("Summary", ""),
                 "consequence": r.get("Consequence", ""),
                 "remedy": r.get("Remedy", ""),
-            })
-        return recalls
+            }
+            for r in data.get("results", [])
+        ]
 
 
-async def _fetch_complaints(session, year, make, model):
+async def _fetch_complaints(session, query):
     """Fetch consumer complaints from NHTSA Complaints API."""
-    url = (
-        f"https://api.nhtsa.gov/complaints/complaintsByVehicle"
-        f"?make={quote(make)}&model={quote(model)}&modelYear={quote(str(year))}"
-    )
+    url = f"https://api.nhtsa.gov/complaints/complaintsByVehicle?{query}"
     async with session.get(url, timeout=TIMEOUT) as resp:
         if resp.status != 200:
             return []
-        data = await resp.json(content_type=None)
-        results = data.get("results", [])
-        complaints = []
-        for r in results[:20]:
-            complaints.append({
+        data = orjson.loads(await resp.read())
+        return [
+            {
                 "date": r.get("dateOfIncident", r.get("dateComplaintFiled", "")),
                 "component": r.get("components", ""),
                 "summary": r.get("summary", ""),
                 "crash": r.get("crash", "N") == "Y",
                 "fire": r.get("fire", "N") == "Y",
-            })
-        return complaints
+            }
+            for r in data.get("results", [])[:20]
+        ]
+
+
+async def _safe(coro, fallback):
+    """Await coro, returning fallback if it raises, so one endpoint failing doesn't sink the rest"""
+    try:
+        return await coro
+    except Exception:
+        return fallback
 
 
 async def _get_safety_data(year, make, model):
     """Fetch all three NHTSA endpoints concurrently."""
-    async with aiohttp.ClientSession() as session:
-        ratings_result, recalls_result, complaints_result = await asyncio.gather(
-            _fetch_safety_ratings(session, year, make, model),
-            _fetch_recalls(session, year, make, model),
-            _fetch_complaints(session, year, make, model),
-            return_exceptions=True,
-        )
+    # Escape once; the ratings endpoint takes path segments, the other two a query
+    path = f"modelyear/{quote(year)}/make/{quote(make)}/model/{quote(model)}"
+    query = urlencode({"make": make, "model": model, "modelYear": year}, quote_via=quote)
+
+    session = _get_session()
+    safety, recalls, complaints = await asyncio.gather(
+        _safe(_fetch_safety_ratings(session, path), None),
+        _safe(_fetch_recalls(session, query), []),
+        _safe(_fetch_complaints(session, query), []),
+    )
 
-    # Handle individual failures gracefully
-    if isinstance(ratings_result, Exception) or ratings_result is None:
+    if safety is None:
         safety = {
             "overall_rating": "Not Rated",
             "frontal_crash": "Not Rated",
@@ -117,11 +189,6 @@ async def _get_safety_data(year, make, model):
             "rollover": "Not Rated",
             "ratings_available": False,
         }
-    else:
-        safety = ratings_result
-
-    recalls = [] if isinstance(recalls_result, Exception) else recalls_result
-    complaints = [] if isinstance(complaints_result, Exception) else complaints_result
 
     # Total complaint count is the full results length (complaints list is capped at 20)
     complaint_count = len(complaints)
@@ -138,9 +205,20 @@ async def _get_safety_data(year, make, model):
 
 
 class handler(BaseHTTPRequestHandler):
+    def _json_response(self, status, data):
+        body, headers = encode_json(self, data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for k, v in headers:
+            self.send_header(k, v)
+        for k, v in _CORS_HEADERS:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_OPTIONS(self):
         self.send_response(204)
-        for k, v in _cors_headers().items():
+        for k, v in _CORS_HEADERS:
             self.send_header(k, v)
         self.end_headers()
 
@@ -152,83 +230,61 @@ class handler(BaseHTTPRequestHandler):
             make = params.get("make", [None])[0]
             model = params.get("model", [None])[0]
             year = params.get("year", [None])[0]
+            fields = params.get("fields", [None])[0]
 
             if not make or not model or not year:
-                self.send_response(400)
-                self.send_header("Content-type", "application/json")
-                for k, v in _cors_headers().items():
-                    self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self._json_response(400, {
                     "success": False,
                     "error": "Missing required parameters: make, model, year",
-                }).encode())
+                })
                 return
 
             try:
                 year_int = int(year)
             except (ValueError, TypeError):
-                self.send_response(400)
-                self.send_header("Content-type", "application/json")
-                for k, v in _cors_headers().items():
-                    self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self._json_response(400, {
                     "success": False,
                     "error": "Invalid year value. Must be a number.",
-                }).encode())
+                })
                 return
 
             if year_int < 1990 or year_int > 2030:
-                self.send_response(400)
-                self.send_header("Content-type", "application/json")
-                for k, v in _cors_headers().items():
-                    self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self._json_response(400, {
                     "success": False,
                     "error": "Invalid year value. Must be between 1990 and 2030.",
-                }).encode())
+                })
                 return
 
-            year = str(year_int)
-
             # Check cache
-            cache_key = f"{make.lower()}_{model.lower()}_{year}"
-            if cache_key in _cache:
-                result = _cache[cache_key]
-            else:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                result = loop.run_until_complete(_get_safety_data(year, make, model))
-                loop.close()
-                _cache[cache_key] = result
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            for k, v in _cors_headers().items():
-                self.send_header(k, v)
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            cache_key = f"{make.lower()}_{model.lower()}_{year_int}"
+            result = _cache_get(cache_key)
+            if result is None:
+                # Fetch on the shared loop
+                try:
+                    result = run_async(_get_safety_data(str(year_int), make, model), timeout=_SAFETY_TIMEOUT)
+                except TimeoutError:
+                    self._json_response(504, {
+                        "success": False,
+                        "error": "Timed out fetching NHTSA data",
+                    })
+                    return
+                _cache_put(cache_key, result)
+
+            if fields:
+                # The cache keeps the full result; trim only what is sent
+                wanted = _RESULT_FIELDS.intersection(f.strip() for f in fields.split(","))
+                result = {k: v for k, v in result.items() if k == "success" or k in wanted}
+
+            self._json_response(200, result)
 
         except ValueError:
-            self.send_response(400)
-            self.send_header("Content-type", "application/json")
-            for k, v in _cors_headers().items():
-                self.send_header(k, v)
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self._json_response(400, {
                 "success": False,
                 "error": "Invalid year parameter - must be a number",
-            }).encode())
+            })
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header("Content-type", "application/json")
-            for k, v in _cors_headers().items():
-                self.send_header(k, v)
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self._json_response(500, {
                 "success": False,
                 "error": str(e),
-            }).encode())
+            })
@@ -5,20 +5,26 @@ Deployed as a Vercel serverless function.
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+import atexit
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
+import lxml.html
+from lxml.etree import XPath
 from datetime import datetime
 from urllib.parse import quote_plus
 import re
 import hashlib
+import threading
 
 from api.utils.response import send_json, send_options
+from api.utils.aio import run_async
 from api.utils.rate_limit import RateLimiter
 
 
 _limiter = RateLimiter(max_requests=10, window_seconds=60)
+_MAX_BODY_BYTES = 64 * 1024  # search params are a handful of short fields
 
 
 USER_AGENT = (
@@ -29,20 +35,106 @@ USER_AGENT = (
 HEADERS = {"User-Agent": USER_AGENT}
 TIMEOUT = aiohttp.ClientTimeout(total=12)
 
+# Lives on the shared loop so its keep-alive connections survive across
+# warm invocations
+_session = None  # created lazily; see _get_session()
+_SEARCH_TIMEOUT = 50  # seconds the handler waits; inside the 60s maxDuration
+
+
+def _get_session():
+    """Return the shared ClientSession, creating it on first use. Runs on the shared loop."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=75),
+            # Cookies a site sets for one search must not leak into the next
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+    return _session
+
+
+def _close_session():
+    """Close the shared session on interpreter exit so connections shut cleanly"""
+    if _session is not None and not _session.closed:
+        try:
+            run_async(_session.close(), timeout=2)
+        except Exception as e:
+            print(f"[search] session close error: {e}")
+
+
+atexit.register(_close_session)
+
+
+def _class_token(name):
+    # Strainers see the raw class attribute string, so match one token of it
+    return re.compile(rf"(?:^|\s){re.escape(name)}(?:\s|$)")
+
+
+_parser_local = threading.local()
+_MAX_PARSERS_PER_THREAD = 8  # charsets come from response headers
+
+
+def _html_parser(encoding):
+    """lxml HTML parser for a response charset, built once per charset per thread.
+
+    A parser instance only parses one document at a time; today every scrape
+    parses on the shared loop, but a process-wide parser would serialize any
+    scrape moved off it.
+    """
+    parsers = getattr(_parser_local, "parsers", None)
+    if parsers is None:
+        parsers = _parser_local.parsers = {}
+    parser = parsers.get(encoding)
+    if parser is None:
+        if len(parsers) >= _MAX_PARSERS_PER_THREAD:
+            parsers.clear()
+        parser = parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+    return parser
+
+
+def _cl_image_container(name, attrs):
+    """Strainer filter for the containers _fetch_cl_listing_image looks at."""
+    if "data-ids" in attrs or attrs.get("id") == "thumbs":
+        return True
+    return name == "div" and not {"swipe", "gallery"}.isdisjoint(attrs.get("class", "").split())
+
+
+_PRICE_RE = re.compile(r"\$?\s?([\d,]+)")
+_MILEAGE_RE = re.compile(r"([\d,]+)\s*(?:mi|miles|(k)\b)", re.IGNORECASE)  # group 2: "85k" shorthand
+_YEAR_RE = re.compile(r"\b(19[89]\d|20[0-2]\d)\b")
+_CL_THUMB_SIZE_RE = re.compile(r"_\d+x\d+")
+_TITLE_CLASS_RE = re.compile(r"title", re.I)
+_PRICE_CLASS_RE = re.compile(r"price", re.I)
+
+# Craigslist result cards are read with compiled XPath, each field in one libxml2 call
+_HAS_CLASS = 'contains(concat(" ", normalize-space(@class), " "), " {} ")'
+_CL_LISTINGS = XPath(f'(//li[{_HAS_CLASS.format("cl-static-search-result")}])[position() <= 20]')
+_CL_TITLE = XPath(f'(.//div[{_HAS_CLASS.format("title")}])[1]')
+_CL_PRICE = XPath(f'string((.//div[{_HAS_CLASS.format("price")}])[1])', smart_strings=False)
+_CL_HREF = XPath('(.//a)[1]/@href', smart_strings=False)
+
+# Only the result cards survive parsing; the rest of each page is skipped
+CL_IMAGE_CONTAINERS = SoupStrainer(_cl_image_container)
+CARGURUS_RESULTS = SoupStrainer(attrs={"data-cg-ft": "car-blade"})
+CARS_COM_RESULTS = SoupStrainer("div", class_=_class_token("vehicle-card"))
+AUTOTRADER_RESULTS = SoupStrainer("div", attrs={"data-cmp": "inventoryListing"})
+
 
 def _extract_price(text):
     if not text:
         return 0
-    m = re.search(r"\$?\s?([\d,]+)", text)
+    m = _PRICE_RE.search(text)
     return int(m.group(1).replace(",", "")) if m else 0
 
 
 def _extract_mileage(text):
     if not text:
         return None
-    m = re.search(r"([\d,]+)\s*(?:mi|miles|k\b)", text, re.IGNORECASE)
+    m = _MILEAGE_RE.search(text)
     if m:
         val = int(m.group(1).replace(",", ""))
+        if m.group(2):
+            val *= 1000
         return val if val < 900000 else None
     return None
 
@@ -50,11 +142,13 @@ def _extract_mileage(text):
 def _extract_year(text):
     if not text:
         return None
-    m = re.search(r"\b(19[89]\d|20[0-2]\d)\b", text)
+    m = _YEAR_RE.search(text)
     return int(m.group(0)) if m else None
 
 
 def _make_id(source, url):
+    # Ids must stay stable across deploys: the frontend persists favorites by id
+    # in localStorage, so swapping the hash would orphan every saved favorite
     h = hashlib.md5(url.encode()).hexdigest()[:10]
     return f"{source}_{h}"
 
@@ -80,8 +174,8 @@ async def _fetch_cl_listing_image(session, url, semaphore):
             async with session.get(url, headers=HEADERS, timeout=TIMEOUT) as resp:
                 if resp.status != 200:
                     return None
-                html = await resp.text()
-                soup = BeautifulSoup(html, "html.parser")
+                raw = await resp.read()
+                soup = BeautifulSoup(raw, "lxml", parse_only=CL_IMAGE_CONTAINERS, from_encoding=resp.charset)
 
                 # Method 1: gallery div with data-ids attribute
                 for el in soup.find_all(attrs={"data-ids": True}):
@@ -108,7 +202,7 @@ async def _fetch_cl_listing_image(session, url, semaphore):
                     if img:
                         src = img.get("src")
                         if src:
-                            return re.sub(r'_\d+x\d+', '_600x450', src)
+                            return _CL_THUMB_SIZE_RE.sub('_600x450', src)
 
                 # Method 4: thumbs
                 thumbs = soup.find("div", id="thumbs")
@@ -143,23 +237,24 @@ async def scrape_craigslist(session, location, make, model, max_price, max_milea
         async with session.get(base_url, params=params, headers=HEADERS, timeout=TIMEOUT) as resp:
             if resp.status != 200:
                 return results
-            html = await resp.text()
-            soup = BeautifulSoup(html, "html.parser")
+            # Bytes go straight to libxml2, which decodes them itself
+            raw = await resp.read()
+            doc = lxml.html.document_fromstring(raw, parser=_html_parser(resp.charset or "utf-8"))
+            scraped_at = datetime.now().isoformat()
 
-            for li in soup.find_all("li", class_="cl-static-search-result")[:20]:
+            for li in _CL_LISTINGS(doc):
                 try:
-                    title_el = li.find("div", class_="title")
-                    price_el = li.find("div", class_="price")
-                    link_el = li.find("a")
-                    if not (title_el and link_el):
+                    title_els = _CL_TITLE(li)
+                    hrefs = _CL_HREF(li)
+                    if not (title_els and hrefs):
                         continue
 
-                    url = link_el.get("href", "")
+                    url = hrefs[0]
                     if not url.startswith("http"):
                         url = f"https://{location}.craigslist.org{url}"
 
-                    title = title_el.text.strip()
-                    price = _extract_price(price_el.text if price_el else "")
+                    title = title_els[0].text_content().strip()
+                    price = _extract_price(_CL_PRICE(li))
                     mileage = _extract_mileage(title)
                     year = _extract_year(title)
 
@@ -176,7 +271,7 @@ async def scrape_craigslist(session, location, make, model, max_price, max_milea
                         "mileage": mileage,
                         "year": year,
                         "image_url": None,
-                        "scraped_at": datetime.now().isoformat(),
+                        "scraped_at": scraped_at,
                     })
                 except Exception:
                     continue
@@ -218,12 +313,13 @@ async def scrape_cargurus(session, make, model, max_price, max_mileage, min_year
             if resp.status != 200:
                 return results
             html = await resp.text()
-            soup = BeautifulSoup(html, "html.parser")
+            soup = BeautifulSoup(html, "lxml", parse_only=CARGURUS_RESULTS)
+            scraped_at = datetime.now().isoformat()
 
-            for card in soup.select('[data-cg-ft="car-blade"]')[:15]:
+            for card in soup.select('[data-cg-ft="car-blade"]', limit=15):
                 try:
-                    title_el = card.find("h4") or card.find("a", class_=re.compile(r"title", re.I))
-                    price_el = card.find("span", class_=re.compile(r"price", re.I))
+                    title_el = card.find("h4") or card.find("a", class_=_TITLE_CLASS_RE)
+                    price_el = card.find("span", class_=_PRICE_CLASS_RE)
                     link_el = card.find("a", href=True)
                     img_el = card.find("img")
 
@@ -253,7 +349,7 @@ async def scrape_cargurus(session, make, model, max_price, max_mileage, min_year
                         "mileage": mileage,
                         "year": year,
                         "image_url": image_url,
-                        "scraped_at": datetime.now().isoformat(),
+                        "scraped_at": scraped_at,
                     })
                 except Exception:
                     continue
@@ -285,9 +381,10 @@ async def scrape_cars_com(session, make, model, max_price, max_mileage, min_year
             if resp.status != 200:
                 return results
             html = await resp.text()
-            soup = BeautifulSoup(html, "html.parser")
+            soup = BeautifulSoup(html, "lxml", parse_only=CARS_COM_RESULTS)
+            scraped_at = datetime.now().isoformat()
 
-            for card in soup.find_all("div", class_="vehicle-card")[:15]:
+            for card in soup.find_all("div", class_="vehicle-card", limit=15):
                 try:
                     title_el = card.find("h2", class_="title") or card.find("h2")
                     price_el = card.find("span", class_="primary-price")
@@ -321,7 +418,7 @@ async def scrape_cars_com(session, make, model, max_price, max_mileage, min_year
                         "mileage": mileage,
                         "year": year,
                         "image_url": image_url,
-                        "scraped_at": datetime.now().isoformat(),
+                        "scraped_at": scraped_at,
                     })
                 except Exception:
                     continue
@@ -352,12 +449,13 @@ async def scrape_autotrader(session, make, model, max_price, max_mileage, min_ye
             if resp.status != 200:
                 return results
             html = await resp.text()
-            soup = BeautifulSoup(html, "html.parser")
+            soup = BeautifulSoup(html, "lxml", parse_only=AUTOTRADER_RESULTS)
+            scraped_at = datetime.now().isoformat()
 
-            for card in soup.find_all("div", attrs={"data-cmp": "inventoryListing"})[:15]:
+            for card in soup.find_all("div", attrs={"data-cmp": "inventoryListing"}, limit=15):
                 try:
                     title_el = card.find("h3") or card.find("h2")
-                    price_el = card.find("span", attrs={"data-cmp": "price"}) or card.find("div", class_=re.compile(r"price", re.I))
+                    price_el = card.find("span", attrs={"data-cmp": "price"}) or card.find("div", class_=_PRICE_CLASS_RE)
                     link_el = card.find("a", attrs={"data-cmp": "listingTitle"}) or card.find("a", href=True)
                     img_el = card.find("img")
 
@@ -387,7 +485,7 @@ async def scrape_autotrader(session, make, model, max_price, max_mileage, min_ye
                         "mileage": mileage,
                         "year": year,
                         "image_url": image_url,
-                        "scraped_at": datetime.now().isoformat(),
+                        "scraped_at": scraped_at,
                     })
                 except Exception:
                     continue
@@ -475,14 +573,14 @@ async def search_all(params):
     location = validated["location"]
     zip_code = validated["zip_code"]
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [
-            scrape_craigslist(session, location, make, model, max_price, max_mileage, min_year, max_year),
-            scrape_cargurus(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
-            scrape_cars_com(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
-            scrape_autotrader(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    session = _get_session()
+    tasks = [
+        scrape_craigslist(session, location, make, model, max_price, max_mileage, min_year, max_year),
+        scrape_cargurus(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
+        scrape_cars_com(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
+        scrape_autotrader(session, make, model, max_price, max_mileage, min_year, max_year, zip_code),
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
 
     vehicles = []
     sources_searched = []
@@ -494,8 +592,13 @@ async def search_all(params):
         else:
             sources_searched.append({"name": name, "count": 0, "error": str(result)})
 
-    # Filter out $0 price listings
-    vehicles = [v for v in vehicles if v.get("price", 0) > 0]
+    # Filter out $0 price listings and repeats of the same listing URL
+    # (sponsored cards recur on a page), keeping the first one seen
+    unique = {}
+    for v in vehicles:
+        if v.get("price", 0) > 0:
+            unique.setdefault(v["id"], v)
+    vehicles = list(unique.values())
 
     # Sort by price ascending
     vehicles.sort(key=lambda v: v.get("price", 999999))
@@ -523,6 +626,21 @@ class handler(BaseHTTPRequestHandler):
         })
 
     def do_POST(self):
+        # Reject oversize bodies before any rate-limit bookkeeping or reads
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            send_json(self, 400, {"success": False, "error": "Invalid Content-Length header."})
+            return
+        if length > _MAX_BODY_BYTES:
+            send_json(self, 413, {
+                "success": False,
+                "error": f"Request body too large (limit {_MAX_BODY_BYTES // 1024} KB).",
+            })
+            return
+
         # Get client IP using shared utility
         client_ip = _limiter.get_client_ip(self)
 
@@ -534,18 +652,24 @@ class handler(BaseHTTPRequestHandler):
             return
 
         try:
-            length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(length).decode("utf-8") if length > 0 else "{}"
-            data = json.loads(body)
-
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            vehicles, sources = loop.run_until_complete(search_all(data))
-            loop.close()
-
-            total = len(vehicles)
-            avg_price = round(sum(v["price"] for v in vehicles) / total, 2) if total else 0
+            body = self.rfile.read(length) if length > 0 else b"{}"
+            data = orjson.loads(body)
+
+            # Run the scrapers on the shared loop
+            try:
+                vehicles, sources = run_async(search_all(data), timeout=_SEARCH_TIMEOUT)
+            except TimeoutError:
+                send_json(self, 504, {
+                    "success": False,
+                    "error": "Timed out searching listing sites.",
+                    "timestamp": datetime.now(),
+                })
+                return
+
+            # One Python-level pass; sum/min/max then run over the list in C
             prices = [v["price"] for v in vehicles]
+            total = len(prices)
+            avg_price = round(sum(prices) / total, 2) if total else 0
 
             send_json(self, 200, {
                 "success": True,
@@ -559,17 +683,17 @@ class handler(BaseHTTPRequestHandler):
                     "max_price": max(prices) if prices else 0,
                 },
                 "search_params": data,
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.now(),
             })
         except ValueError as e:
             send_json(self, 400, {
                 "success": False,
                 "error": str(e),
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.now(),
             })
         except Exception as e:
             send_json(self, 500, {
                 "success": False,
                 "error": str(e),
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.now(),
             })
@@ -0,0 +1,21 @@
+import asyncio
+import threading
+
+# One event loop per process, running in a daemon thread, so aiohttp sessions
+# and their keep-alive connections survive across warm invocations
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="aio-loop", daemon=True).start()
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared loop and block until it finishes.
+
+    Raises TimeoutError if it takes longer than timeout seconds; the coroutine
+    is cancelled first so it stops holding connections.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _loop)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
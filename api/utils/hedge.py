@@ -0,0 +1,64 @@
+import concurrent.futures
+
+# Threads for hedged requests, shared by every endpoint that races models. A
+# losing request can't be interrupted and keeps its thread until urllib3 gives
+# up (read timeout plus retries), so the pool leaves room for several stranded
+# losers before a new race would queue behind them. Threads are only created
+# when none is idle, so the headroom costs nothing while the primary is healthy.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+def race(attempts, hedge_after):
+    """Run attempts in order, hedging to the next one when the current is slow.
+
+    attempts is a sequence of (name, fn) pairs, where fn takes no arguments
+    and returns an answer or raises. The first starts immediately; the next is
+    launched once the current one fails or has been running for hedge_after
+    seconds, and the first success wins. Returns (name, answer, errors), or
+    (None, None, errors) if every attempt fails; errors maps name to the
+    exception it raised, in the order they failed.
+    """
+    remaining = iter(attempts)
+    names = {}
+    errors = {}
+
+    def launch():
+        attempt = next(remaining, None)
+        if attempt is None:
+            return None
+        name, fn = attempt
+        future = _executor.submit(fn)
+        names[future] = name
+        return future
+
+    pending = {launch()}
+    exhausted = False
+
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending,
+            timeout=None if exhausted else hedge_after,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in done:
+            name = names[future]
+            try:
+                answer = future.result()
+            except Exception as exc:
+                errors[name] = exc
+                continue
+            # An in-flight loser holds its worker until it finishes or times
+            # out, which the pool's headroom absorbs; a queued one is dropped
+            for other in pending:
+                other.cancel()
+            return name, answer, errors
+
+        # Either something failed or nothing answered in time: hedge
+        if not exhausted:
+            future = launch()
+            if future is None:
+                exhausted = True
+            else:
+                pending.add(future)
+
+    return None, None, errors
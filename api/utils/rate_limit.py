@@ -8,7 +8,7 @@ class RateLimiter:
 
     def is_limited(self, ip):
         """Returns True if the IP has exceeded the rate limit."""
-        now = time.time()
+        now = time.monotonic()
         if ip not in self._store:
             self._store[ip] = []
         self._store[ip] = [t for t in self._store[ip] if now - t < self._window]
@@ -1,4 +1,9 @@
-import json
+import gzip
+
+import orjson
+
+_GZIP_MIN_BYTES = 1024  # below this the header and CPU cost more than they save
+
 
 def cors_headers():
     """Return standard CORS headers dict."""
@@ -8,14 +13,36 @@ def cors_headers():
         "Access-Control-Allow-Headers": "Content-Type, Authorization",
     }
 
+
+def encode_json(handler, data):
+    """Serialize data for handler's client, gzipped when accepted and worth it.
+
+    Returns (body, headers), headers being the Content-Length and, for
+    compressible bodies, Vary/Content-Encoding pairs to send with it.
+    """
+    body = orjson.dumps(data)
+    headers = []
+    if len(body) >= _GZIP_MIN_BYTES:
+        headers.append(("Vary", "Accept-Encoding"))
+        if "gzip" in handler.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=4)
+            headers.append(("Content-Encoding", "gzip"))
+    headers.append(("Content-Length", str(len(body))))
+    return body, headers
+
+
 def send_json(handler, status, data):
     """Send a JSON response with CORS headers."""
+    body, headers = encode_json(handler, data)
     handler.send_response(status)
     handler.send_header("Content-Type", "application/json")
+    for k, v in headers:
+        handler.send_header(k, v)
     for k, v in cors_headers().items():
         handler.send_header(k, v)
     handler.end_headers()
-    handler.wfile.write(json.dumps(data).encode())
+    handler.wfile.write(body)
+
 
 def send_options(handler):
     """Handle CORS preflight OPTIONS request."""
@@ -24,6 +51,7 @@ def send_options(handler):
         handler.send_header(k, v)
     handler.end_headers()
 
+
 def error_response(message, hint=None):
     """Create standardized error response dict."""
     resp = {"success": False, "error": message}
@@ -0,0 +1,70 @@
+import sys
+import os
+
+import pytest
+
+# Add project root to path so we can import api modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api.analyze as analyze
+from api.analyze import GEMINI_MODELS, _build_prompt, _cache_key, _fmt_int, _strip_fences
+
+
+class TestFmtInt:
+    def test_integer(self):
+        assert _fmt_int(85000) == "85,000"
+
+    def test_missing(self):
+        assert _fmt_int(None) == "N/A"
+
+    def test_non_numeric(self):
+        assert _fmt_int("unknown", "0") == "0"
+
+
+class TestBuildPrompt:
+    def test_listing_line(self):
+        vehicles = [{"title": "2019 Honda Civic", "price": 18500, "mileage": 45000, "year": 2019, "source": "Craigslist"}]
+        prompt = _build_prompt("Honda", "Civic", 2015, 2020, vehicles)
+        assert "1. 2019 Honda Civic | Price: $18,500 | Mileage: 45,000 mi" in prompt
+        assert "Honda Civic (2015-2020)" in prompt
+
+    def test_missing_mileage_does_not_raise(self):
+        # Scrapers emit mileage=None when a listing has no odometer reading
+        vehicles = [{"title": "2012 Ford Focus", "price": 6000, "mileage": None}]
+        prompt = _build_prompt("Ford", "Focus", None, None, vehicles)
+        assert "Mileage: N/A mi" in prompt
+
+
+class TestCacheKey:
+    def test_deterministic(self):
+        params = {"make": "Honda", "model": "Civic", "min_year": 2015}
+        assert _cache_key(params, 5) == _cache_key(dict(params), 5)
+
+    def test_varies_with_count(self):
+        params = {"make": "Honda", "model": "Civic"}
+        assert _cache_key(params, 5) != _cache_key(params, 6)
+
+
+class TestStripFences:
+    def test_fenced_with_language(self):
+        assert _strip_fences('```json\n{"a": 1}\n```') == '{"a": 1}'
+
+    def test_unterminated_fence(self):
+        # Output cut off by maxOutputTokens never reaches the closing fence
+        assert _strip_fences('```json\n{"a": 1}') == '{"a": 1}'
+
+    def test_closing_fence_only(self):
+        assert _strip_fences('{"a": 1}\n```') == '{"a": 1}'
+
+    def test_unfenced(self):
+        assert _strip_fences('  {"a": 1}\n') == '{"a": 1}'
+
+
+class TestCallGemini:
+    def test_all_models_failed(self, monkeypatch):
+        def fake_try_model(model_name, api_key, payload):
+            raise RuntimeError(f"{model_name}: HTTP 500")
+
+        monkeypatch.setattr(analyze, "_try_model", fake_try_model)
+        with pytest.raises(RuntimeError, match=f"Last error: {GEMINI_MODELS[-1]}: HTTP 500"):
+            analyze._call_gemini("prompt", "key")
@@ -3,16 +3,22 @@ Test script for the chat.py Gemini REST API integration.
 Run with: python tests/test_chat_api.py
 Or with API key: GOOGLE_API_KEY=your_key python tests/test_chat_api.py
 """
+import http.server
 import json
 import os
 import sys
+import threading
+import urllib.error
+import urllib.request
 
 # Add parent dir to path to import from api/
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import api.chat as chat
 from api.chat import (
     _convert_messages,
     _build_context_message,
+    _system_instruction,
     SYSTEM_PROMPT,
     _PRIMARY_MODEL,
     _FALLBACK_MODEL,
@@ -30,9 +36,7 @@ def test_message_conversion():
         {"role": "assistant", "content": "A Honda Civic is reliable."},
         {"role": "user", "content": "What about Toyota?"},
     ]
-    context = None
-
-    history, latest_text = _convert_messages(messages, context)
+    history, latest_text = _convert_messages(messages)
 
     print(f"History entries: {len(history)}")
     for i, entry in enumerate(history):
@@ -73,6 +77,25 @@ def test_context_building():
     print("✓ PASSED\n")
 
 
+def test_context_in_system_instruction():
+    """Test that context is appended to the system prompt, not the history."""
+    print("=" * 60)
+    print("TEST 2b: Context in system instruction")
+    print("=" * 60)
+
+    context = {"current_vehicle": {"make": "Honda", "price": 18500}}
+
+    text = _system_instruction(context)["parts"][0]["text"]
+    print(f"System instruction length: {len(text)}")
+
+    # Stable prefix first so Gemini can reuse it across requests
+    assert text.startswith(SYSTEM_PROMPT)
+    assert "CURRENT VEHICLE" in text
+    assert "18500" in text
+    assert _system_instruction(None)["parts"][0]["text"] == SYSTEM_PROMPT
+    print("✓ PASSED\n")
+
+
 def test_payload_format():
     """Test that the full payload matches Gemini API format."""
     print("=" * 60)
@@ -80,9 +103,7 @@ def test_payload_format():
     print("=" * 60)
 
     messages = [{"role": "user", "content": "Hello"}]
-    context = None
-
-    history, latest_text = _convert_messages(messages, context)
+    history, latest_text = _convert_messages(messages)
 
     # Build contents array exactly like chat.py does
     contents = []
@@ -233,6 +254,58 @@ def test_model_names():
     print("✓ PASSED\n")
 
 
+def _patch_models(fake, hedge_after=0.1):
+    """Swap in a fake model call and a short hedge delay; returns a restore function."""
+    saved = chat._try_gemini_model, chat._HEDGE_AFTER
+    chat._try_gemini_model, chat._HEDGE_AFTER = fake, hedge_after
+
+    def restore():
+        chat._try_gemini_model, chat._HEDGE_AFTER = saved
+    return restore
+
+
+def test_race_both_failed_returns_500():
+    """When both models fail the handler answers 500 with each model's error."""
+    print("=" * 60)
+    print("TEST 6: Both models failed")
+    print("=" * 60)
+
+    def fake(model_name, api_key, system_instruction, history, latest_text):
+        raise ValueError(f"HTTP 503 from {model_name}")
+
+    restore = _patch_models(fake)
+    saved_key = os.environ.get("GOOGLE_API_KEY")
+    os.environ["GOOGLE_API_KEY"] = "test-key"
+    server = http.server.HTTPServer(("127.0.0.1", 0), chat.handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        req = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_port}/api/chat",
+            data=json.dumps({"messages": [{"role": "user", "content": "hi"}]}).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            urllib.request.urlopen(req, timeout=10)
+            raise AssertionError("expected HTTP 500")
+        except urllib.error.HTTPError as e:
+            assert e.code == 500, e.code
+            body = json.loads(e.read())
+        details = body["details"]
+        assert body["success"] is False
+        assert details["primary_error"] == f"HTTP 503 from {_PRIMARY_MODEL}"
+        assert details["fallback_error"] == f"HTTP 503 from {_FALLBACK_MODEL}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        restore()
+        if saved_key is None:
+            os.environ.pop("GOOGLE_API_KEY", None)
+        else:
+            os.environ["GOOGLE_API_KEY"] = saved_key
+    print("✓ PASSED\n")
+
+
 if __name__ == "__main__":
     print("\n" + "=" * 60)
     print("CHAT API TEST SUITE")
@@ -240,8 +313,10 @@ if __name__ == "__main__":
 
     test_message_conversion()
     test_context_building()
+    test_context_in_system_instruction()
     test_payload_format()
     test_model_names()
+    test_race_both_failed_returns_500()
     test_live_api_call()
 
     print("=" * 60)
@@ -0,0 +1,57 @@
+import sys
+import os
+import threading
+import time
+
+import pytest
+
+# Add project root to path so we can import api modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.utils.hedge import race
+
+HEDGE_AFTER = 0.1
+
+
+def _answer(name):
+    return lambda: f"answer from {name}"
+
+
+def _fail(name):
+    def fn():
+        raise RuntimeError(f"HTTP 503 from {name}")
+    return fn
+
+
+class TestRace:
+    @pytest.fixture
+    def stalled(self):
+        # An attempt that hangs until the test ends
+        release = threading.Event()
+        yield lambda: release.wait(5)
+        release.set()
+
+    def test_primary_answers(self):
+        assert race([("a", _answer("a")), ("b", _answer("b"))], HEDGE_AFTER) == ("a", "answer from a", {})
+
+    def test_back_to_back_hedges_do_not_queue(self, stalled):
+        # Each race strands a running primary; the next race's fallback must
+        # still start on time instead of waiting for a free worker
+        for _ in range(4):
+            start = time.monotonic()
+            name, answer, errors = race([("a", stalled), ("b", _answer("b"))], HEDGE_AFTER)
+            assert (name, answer, errors) == ("b", "answer from b", {})
+            assert time.monotonic() - start < 1.0
+
+    def test_primary_failure_hedges_immediately(self):
+        start = time.monotonic()
+        name, answer, errors = race([("a", _fail("a")), ("b", _answer("b"))], 5.0)
+        assert time.monotonic() - start < 1.0
+        assert (name, answer) == ("b", "answer from b")
+        assert str(errors["a"]) == "HTTP 503 from a"
+
+    def test_all_failed(self):
+        name, answer, errors = race([("a", _fail("a")), ("b", _fail("b"))], HEDGE_AFTER)
+        assert (name, answer) == (None, None)
+        assert list(errors) == ["a", "b"]
+        assert str(errors["b"]) == "HTTP 503 from b"
@@ -0,0 +1,94 @@
+import sys
+import os
+import time
+
+# Add project root to path so we can import api modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import api.review as review
+from api.review import FALLBACK_MODEL, _extract_json_object, _parse_gemini_response
+
+
+class TestExtractJsonObject:
+    def test_first_balanced_object(self):
+        text = 'Here you go: {"a": {"b": 1}} and also {"c": 2}'
+        assert _extract_json_object(text) == '{"a": {"b": 1}}'
+
+    def test_braces_inside_strings_ignored(self):
+        text = 'x {"summary": "uses } and { freely", "q": "say \\"}\\""} y'
+        assert _extract_json_object(text) == '{"summary": "uses } and { freely", "q": "say \\"}\\""}'
+
+    def test_unbalanced(self):
+        assert _extract_json_object('{"a": 1') is None
+        assert _extract_json_object('no json here') is None
+
+
+class TestParseGeminiResponse:
+    def test_plain_json(self):
+        assert _parse_gemini_response('{"summary": "ok"}') == {"summary": "ok"}
+
+    def test_fenced_json(self):
+        assert _parse_gemini_response('```json\n{"summary": "ok"}\n```') == {"summary": "ok"}
+
+    def test_object_followed_by_prose_with_braces(self):
+        text = 'Sure! {"summary": "ok"} Let me know if you want {more}.'
+        assert _parse_gemini_response(text) == {"summary": "ok"}
+
+    def test_unparseable(self):
+        with pytest.raises(ValueError):
+            _parse_gemini_response("no json at all")
+
+
+class TestCallGemini:
+    def test_all_models_failed_reraises_last_error(self, monkeypatch):
+        def fake_try_model(model_name, api_key, payload):
+            raise ValueError(f"Empty response from {model_name}")
+
+        monkeypatch.setattr(review, "_try_model", fake_try_model)
+        with pytest.raises(ValueError, match=f"Empty response from {FALLBACK_MODEL}"):
+            review._call_gemini("prompt", "key")
+
+
+class TestCacheKey:
+    def test_same_bucket_shares_a_key(self):
+        assert review._cache_key("Honda", "Civic", 2015, 12100, 84000) == review._cache_key("honda", "civic", 2015, 12900, 89999)
+
+    def test_price_and_mileage_split_keys(self):
+        base = review._cache_key("Honda", "Civic", 2015, 12000, 84000)
+        assert review._cache_key("Honda", "Civic", 2015, 15000, 84000) != base
+        assert review._cache_key("Honda", "Civic", 2015, 12000, 124000) != base
+
+
+class TestReviewCache:
+    @pytest.fixture(autouse=True)
+    def fresh_cache(self, tmp_path, monkeypatch):
+        # A throwaway database file and an empty memory layer for each test
+        monkeypatch.setattr(review, "_REVIEW_DB_PATH", str(tmp_path / "reviews.db"))
+        monkeypatch.setattr(review, "_db", None)
+        monkeypatch.setattr(review, "_review_cache", review.OrderedDict())
+        yield
+        if review._db is not None:
+            review._db.close()
+
+    def test_sweep_drops_expired_and_excess_rows(self, monkeypatch):
+        monkeypatch.setattr(review, "_REVIEW_DB_MAX_ROWS", 10)
+        monkeypatch.setattr(review, "_DB_SWEEP_EVERY", 5)
+        db = review._review_db()
+        expired = int(time.time() - review._REVIEW_CACHE_TTL - 60)
+        db.execute("INSERT INTO reviews VALUES ('stale', '{}', ?)", (expired,))
+        db.commit()
+
+        for i in range(20):
+            review._cache_put(f"key{i}", {"i": i})
+
+        keys = {key for key, in db.execute("SELECT key FROM reviews")}
+        assert len(keys) == 10
+        assert "stale" not in keys
+
+    def test_corrupt_row_is_a_miss(self):
+        db = review._review_db()
+        db.execute("INSERT INTO reviews VALUES ('honda_civic_2015', '{not json', ?)", (int(time.time()),))
+        db.commit()
+        assert review._cache_get("honda_civic_2015") is None
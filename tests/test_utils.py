@@ -3,12 +3,13 @@ import sys
 import os
 from unittest.mock import patch
 import socket
+import threading
 
 # Add project root to path so we can import api modules
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from api.search.index import _extract_price, _extract_mileage, _extract_year, _year_ok, validate_params
-from api.details import _is_url_allowed
+from api.details import _html_parser, _is_url_allowed, _parse_cargurus, _parse_craigslist, _retry_delay
 
 
 def _fake_getaddrinfo(host, port, *args, **kwargs):
@@ -49,6 +50,9 @@ class TestExtractMileage:
         # May or may not handle 'k' notation - test what it returns
         assert result is None or isinstance(result, int)
 
+    def test_k_means_thousands(self):
+        assert _extract_mileage("2015 Honda Civic 120K") == 120000
+
     def test_no_mileage(self):
         assert _extract_mileage("No mileage info") is None
 
@@ -159,3 +163,103 @@ class TestUrlAllowed:
 
     def test_no_scheme(self, mock_dns):
         assert _is_url_allowed("craigslist.org/listing") == False
+
+    def test_dns_lookup_cached(self, mock_dns):
+        url = "https://dns-cache-test.cars.com/vehicledetail/1/"
+        assert _is_url_allowed(url) == True
+        assert _is_url_allowed(url) == True
+        assert mock_dns.call_count == 1
+
+
+class TestParseCraigslist:
+    HTML = (
+        b'<html><body>'
+        b'<div class="gallery"><img src="https://images.craigslist.org/a_50x50.jpg"></div>'
+        b'<div id="thumbs"><a href="https://images.craigslist.org/a_600x450.jpg">1</a>'
+        b'<a href="https://images.craigslist.org/b_600x450.jpg">2</a></div>'
+        b'<section id="postingbody"><div class="print-qrcode-container">QR Code Link</div>'
+        b'Runs great.</section>'
+        b'<div class="mapAndAttrs"><p class="attrgroup"><span>2015 honda civic</span></p>'
+        b'<p class="attrgroup"><span>VIN: <b>1HGCM</b></span><span>title status: clean</span></p></div>'
+        b'</body></html>'
+    )
+
+    def test_images_deduplicated_in_page_order(self):
+        details = _parse_craigslist(self.HTML, 'utf-8')
+        assert details['images'] == [
+            'https://images.craigslist.org/a_600x450.jpg',
+            'https://images.craigslist.org/b_600x450.jpg',
+        ]
+        assert details['image_url'] == details['images'][0]
+
+    def test_images_are_plain_strings(self):
+        # lxml "smart" strings keep their parent element, and with it the whole
+        # parsed page, alive for as long as the cached result is
+        details = _parse_craigslist(self.HTML, 'utf-8')
+        assert all(type(url) is str for url in details['images'])
+
+    def test_description_and_attrs(self):
+        details = _parse_craigslist(self.HTML, 'utf-8')
+        assert details['description'] == 'Runs great.'
+        assert details['vin'] == '1HGCM'
+        assert details['title_status'] == 'clean'
+
+
+class TestParseCargurus:
+    HTML = (
+        b'<html><body>'
+        b'<dl class="listingDetails"><dt>Transmission</dt><dd> Automatic </dd>'
+        b'<dt>Fuel Type</dt><dd>Gasoline</dd><dt>Exterior Color</dt><dd>Blue</dd>'
+        b'<dt>Stock #</dt><dd>A123</dd></dl>'
+        b'</body></html>'
+    )
+
+    def test_specs_mapped_by_label(self):
+        details = _parse_cargurus(self.HTML, 'utf-8')
+        assert details['transmission'] == 'Automatic'
+        assert details['fuel'] == 'Gasoline'
+        assert details['color'] == 'Blue'
+        assert 'A123' not in details.values()
+
+    def test_nested_and_indented_markup(self):
+        html = (
+            b'<html><body>'
+            b'<div class="sellerComments">\n    <p>Call <b>me</b>\n      today</p>\n</div>'
+            b'<dl class="listingDetails">\n  <dt>\n    Exterior\n    Color\n  </dt>\n'
+            b'  <dd><span>Deep</span> <span>Blue</span></dd>\n'
+            b'  <dt>Fuel <span>Type</span></dt><dd>\n  Gasoline\n</dd>\n</dl>'
+            b'</body></html>'
+        )
+        details = _parse_cargurus(html, 'utf-8')
+        assert details['description'] == 'Call me today'
+        assert details['color'] == 'Deep Blue'
+        assert details['fuel'] == 'Gasoline'
+
+
+class TestHtmlParser:
+    def test_reused_within_a_thread(self):
+        assert _html_parser('utf-8') is _html_parser('utf-8')
+        assert _html_parser('utf-8') is not _html_parser('iso-8859-1')
+
+    def test_not_shared_between_threads(self):
+        # Parse-pool workers must not contend for one parser instance
+        other = []
+        t = threading.Thread(target=lambda: other.append(_html_parser('utf-8')))
+        t.start()
+        t.join()
+        assert other[0] is not _html_parser('utf-8')
+
+
+class TestRetryDelay:
+    def test_uses_retry_after_seconds(self):
+        assert _retry_delay('2', 0) == 2
+
+    def test_exponential_without_header(self):
+        assert _retry_delay(None, 0) == 0.5
+        assert _retry_delay(None, 1) == 1
+
+    def test_http_date_falls_back_to_exponential(self):
+        assert _retry_delay('Wed, 21 Oct 2015 07:28:00 GMT', 1) == 1
+
+    def test_capped(self):
+        assert _retry_delay('120', 0) == 4